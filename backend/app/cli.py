@@ -0,0 +1,49 @@
+"""One-shot management commands, run once per deploy rather than per worker.
+
+Usage:
+    python -m app.cli init-db        # development: create tables + default admin
+    python -m app.cli create-admin   # any environment: default admin only
+"""
+import argparse
+import logging
+
+from app.core.config import settings
+from app.database import engine, Base
+from app.models import import_all_models
+from app.core.security import create_default_admin
+
+logger = logging.getLogger(__name__)
+
+def create_admin():
+    """Create the default admin user if it does not exist"""
+    import_all_models()
+    create_default_admin()
+    logger.info("Default admin user verified")
+
+def init_db():
+    """Create missing tables (development only) and the default admin user"""
+    if settings.ENVIRONMENT == "development":
+        import_all_models()
+        Base.metadata.create_all(bind=engine)
+        logger.info("Database tables created/verified")
+    else:
+        # Staging/production schemas are owned by alembic migrations
+        logger.info(f"Skipping create_all in {settings.ENVIRONMENT}; run `alembic upgrade head` instead")
+
+    create_admin()
+
+COMMANDS = {
+    "init-db": init_db,
+    "create-admin": create_admin,
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.cli")
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    COMMANDS[args.command]()
+
+if __name__ == "__main__":
+    main()
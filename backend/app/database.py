@@ -0,0 +1,42 @@
+from typing import AsyncIterator
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+import redis.asyncio as aioredis
+
+from app.core.config import settings
+from app.models import Base
+
+ASYNC_DATABASE_URL = str(settings.DATABASE_URL).replace("postgresql://", "postgresql+asyncpg://", 1)
+
+# pool_pre_ping is left off: it costs a SELECT 1 on every checkout. Stale
+# connections are recycled by pool_recycle and a keepalive task in lifespan.
+engine = create_engine(
+    str(settings.DATABASE_URL),
+    pool_size=settings.DATABASE_POOL_SIZE,
+    max_overflow=settings.DATABASE_MAX_OVERFLOW,
+    pool_timeout=settings.DATABASE_POOL_TIMEOUT,
+    pool_recycle=settings.DATABASE_POOL_RECYCLE,
+    pool_pre_ping=False,
+)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=settings.DATABASE_POOL_SIZE,
+    max_overflow=settings.DATABASE_MAX_OVERFLOW,
+    pool_timeout=settings.DATABASE_POOL_TIMEOUT,
+    pool_recycle=settings.DATABASE_POOL_RECYCLE,
+    pool_pre_ping=False,
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# Async client shared by the whole app; redis-py picks the hiredis C parser
+# automatically when the hiredis package is installed
+redis_pool = aioredis.ConnectionPool.from_url(settings.REDIS_URL, max_connections=settings.REDIS_MAX_CONNECTIONS)
+redis_client = aioredis.Redis(connection_pool=redis_pool, decode_responses=False)
+
+async def get_db() -> AsyncIterator[AsyncSession]:
+    """Yield an async database session (runs on the event loop, not the threadpool)"""
+    async with AsyncSessionLocal() as db:
+        yield db
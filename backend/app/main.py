@@ -1,108 +1,231 @@
 from fastapi import FastAPI, Depends, HTTPException, status, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
 from fastapi.exceptions import RequestValidationError
 from contextlib import asynccontextmanager
+import anyio
+import asyncio
 import logging
-import sentry_sdk
+import os
+import queue
 import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pythonjsonlogger import jsonlogger
 from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
 import json
+import orjson
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
 
 from app.core.config import settings
-from app.api.v1 import auth, transactions, documents, reports, ai, bank, tax, analytics
 from app.api.websocket import websocket_manager
-from app.database import engine, Base, get_db
-from app.core.security import create_default_admin, get_current_user
-from app.middleware import RateLimitMiddleware, RequestLoggingMiddleware
+from app.database import engine, async_engine, ASYNC_DATABASE_URL, redis_client
+from app.core.security import get_current_user
+from app.middleware import RateLimitMiddleware, RequestLoggingMiddleware, SelectiveGZipMiddleware
 
-# Initialize logging
+# Initialize logging: records are only enqueued on the calling thread; the
+# QueueListener started in lifespan does the formatting and file/stream I/O
+log_queue = queue.SimpleQueue()
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('logs/app.log'),
-        logging.StreamHandler()
-    ]
+    handlers=[QueueHandler(log_queue)]
 )
+logging.getLogger("uvicorn.access").propagate = False
 logger = logging.getLogger(__name__)
 
+def init_sentry():
+    """Initialize Sentry with sampled tracing (profiling only when explicitly enabled)"""
+    import sentry_sdk
+    
+    options = {
+        "dsn": settings.SENTRY_DSN,
+        "traces_sample_rate": settings.SENTRY_TRACES_RATE,
+        "environment": settings.ENVIRONMENT,
+    }
+    if settings.SENTRY_ENABLE_PROFILING:
+        options["profiles_sample_rate"] = settings.SENTRY_PROFILES_RATE
+    
+    sentry_sdk.init(**options)
+
+def create_log_listener() -> QueueListener:
+    """Build the listener that drains log_queue into the file and stream handlers"""
+    formatter = jsonlogger.JsonFormatter('%(asctime)s %(name)s %(levelname)s %(message)s')
+    
+    # One file per process: gunicorn workers rotating a shared file would
+    # rename it under each other and lose or interleave records
+    root, ext = os.path.splitext(settings.LOG_FILE)
+    file_handler = RotatingFileHandler(f"{root}.{os.getpid()}{ext}", maxBytes=50_000_000, backupCount=5)
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+    
+    return QueueListener(log_queue, file_handler, stream_handler)
+
 # Prometheus metrics
 REQUEST_COUNT = Counter('http_requests_total', 'Total HTTP requests', ['method', 'endpoint', 'status'])
 REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency', ['endpoint'])
 
-# Initialize Sentry
-if settings.SENTRY_DSN:
-    sentry_sdk.init(
-        dsn=settings.SENTRY_DSN,
-        traces_sample_rate=1.0,
-        profiles_sample_rate=1.0,
-        environment=settings.ENVIRONMENT,
-    )
+# Pre-bound metric children, so the hot path skips label resolution
+_counter_cache = {}  # (method, endpoint, status) -> Counter
+_latency_cache = {}  # endpoint -> Histogram
+
+class ProcessTimeMiddleware:
+    """Pure ASGI middleware adding X-Process-Time-Us and recording request metrics"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        start = time.perf_counter_ns()
+        status_code = 500
+        
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                elapsed_us = (time.perf_counter_ns() - start) // 1000
+                message["headers"] = [
+                    *message.get("headers", ()),
+                    (b"x-process-time-us", str(elapsed_us).encode()),
+                ]
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            process_time = (time.perf_counter_ns() - start) / 1e9
+            
+            # Label by route template (e.g. /users/{id}), not the raw path,
+            # to keep the number of metric series bounded
+            route = scope.get("route")
+            endpoint = route.path if route is not None else "unmatched"
+            
+            # Record metrics
+            key = (scope["method"], endpoint, status_code)
+            counter = _counter_cache.get(key)
+            if counter is None:
+                counter = REQUEST_COUNT.labels(method=key[0], endpoint=endpoint, status=status_code)
+                _counter_cache[key] = counter
+            counter.inc()
+            
+            histogram = _latency_cache.get(endpoint)
+            if histogram is None:
+                histogram = REQUEST_LATENCY.labels(endpoint=endpoint)
+                _latency_cache[endpoint] = histogram
+            histogram.observe(process_time)
+
+async def _database_keepalive():
+    """Periodically run SELECT 1 on a pooled connection instead of pre-pinging every checkout"""
+    while True:
+        await asyncio.sleep(settings.DATABASE_KEEPALIVE_INTERVAL)
+        try:
+            # Requests are served from the async pool (get_db), so keep that one warm
+            async with async_engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+        except Exception as e:
+            logger.warning(f"Database keepalive failed: {e}")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan context manager for startup/shutdown events"""
-    logger.info(f"Starting AETHER AI Accounting Platform - Environment: {settings.ENVIRONMENT}")
+    app.state.start_time = time.monotonic()
+    
+    log_listener = create_log_listener()
+    log_listener.start()
     
-    # Create database tables
-    try:
-        Base.metadata.create_all(bind=engine)
-        logger.info("Database tables created/verified")
-    except Exception as e:
-        logger.error(f"Database initialization failed: {e}")
-        raise
+    # Initialize Sentry
+    if settings.SENTRY_DSN:
+        init_sentry()
     
-    # Create default admin user
-    try:
-        create_default_admin()
-        logger.info("Default admin user verified")
-    except Exception as e:
-        logger.warning(f"Default admin creation issue: {e}")
+    logger.info(f"Starting AETHER AI Accounting Platform - Environment: {settings.ENVIRONMENT}")
     
-    # Initialize ML models
-    from app.ai.ml_models import ModelManager
-    model_manager = ModelManager()
-    model_manager.load_all_models()
+    # Safety net for any remaining sync dependencies/endpoints run in the threadpool
+    anyio.to_thread.current_default_thread_limiter().total_tokens = settings.THREADPOOL_LIMIT
     
-    # Start background services
+    # Heavy services are imported here rather than at module level so that
+    # importing app.main (tests, tooling, each worker) stays cheap
+    from app.ai.ml_models import ModelManager
     from app.workers.document_worker import start_document_workers
     from app.workers.sync_worker import start_sync_workers
     from app.services.email_service import EmailService
+    from app.services.plaid_service import PlaidService
+    from app.services.ai_result_writer import ai_result_writer
+    from app.models import import_all_models
     
+    # Register every model before the first query so string relationships
+    # (e.g. relationship("Invoice")) resolve against the lazily loaded modules
+    await asyncio.to_thread(import_all_models)
+    
+    model_manager = ModelManager()
     email_service = EmailService()
-    await email_service.initialize()
+    plaid_service = PlaidService()
     
-    # Start WebSocket manager
-    websocket_manager.start()
+    # Initialize ML models and external services concurrently; model loading
+    # runs in a thread so the network handshakes overlap with it. Schema
+    # creation and the default admin are handled once by `python -m app.cli init-db`.
+    init_steps = {
+        "ML models": asyncio.to_thread(model_manager.load_all_models),
+        "Email service": email_service.initialize(),
+        "Plaid service": plaid_service.initialize(),
+    }
+    results = await asyncio.gather(*init_steps.values(), return_exceptions=True)
+    for name, result in zip(init_steps, results):
+        if isinstance(result, Exception):
+            logger.warning(f"{name} initialization issue: {result}")
+        else:
+            logger.info(f"{name} initialized")
     
-    # Initialize external services
-    from app.services.plaid_service import PlaidService
-    plaid_service = PlaidService()
-    await plaid_service.initialize()
+    # Start WebSocket manager once the loop is free, so HTTP traffic can be
+    # accepted without waiting for it to warm up
+    asyncio.get_running_loop().call_soon(websocket_manager.start)
+    
+    keepalive_task = asyncio.create_task(_database_keepalive())
+    ai_result_writer.start()
     
     logger.info("All services initialized successfully")
     
     yield
     
     logger.info("Shutting down AETHER")
+    keepalive_task.cancel()
     websocket_manager.stop()
+    await ai_result_writer.close()
     await email_service.close()
+    await probe_engine.dispose()
+    await async_engine.dispose()
+    engine.dispose()
+    await redis_client.aclose()
+    log_listener.stop()
 
 # Create FastAPI app
 app = FastAPI(
     title=settings.APP_NAME,
     version=settings.APP_VERSION,
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
     docs_url="/api/docs" if settings.DEBUG else None,
     redoc_url="/api/redoc" if settings.DEBUG else None,
     openapi_url="/api/openapi.json" if settings.DEBUG else None,
 )
 
-# Add middleware
+# Never build the OpenAPI schema in production; in debug FastAPI builds it
+# lazily on the first /api/docs hit and memoizes it on app.openapi_schema
+if not settings.DEBUG:
+    app.openapi = lambda: None
+
+# Add middleware (Starlette runs them in reverse order of registration, so
+# CORS is added last to sit outermost and answer preflights immediately)
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=4096)
+if settings.ALLOWED_HOSTS != ["*"]:
+    app.add_middleware(TrustedHostMiddleware, allowed_hosts=settings.ALLOWED_HOSTS)
+app.add_middleware(RateLimitMiddleware, limit=100, window=60)  # 100 requests per minute
+app.add_middleware(RequestLoggingMiddleware)
+app.add_middleware(ProcessTimeMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=settings.BACKEND_CORS_ORIGINS,
@@ -112,11 +235,6 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
-app.add_middleware(GZipMiddleware, minimum_size=1000)
-app.add_middleware(TrustedHostMiddleware, allowed_hosts=["*"])
-app.add_middleware(RateLimitMiddleware, limit=100, window=60)  # 100 requests per minute
-app.add_middleware(RequestLoggingMiddleware)
-
 # Custom exception handlers
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
@@ -137,6 +255,7 @@ async def http_exception_handler(request: Request, exc: HTTPException):
 async def general_exception_handler(request: Request, exc: Exception):
     logger.error(f"Unhandled exception: {exc}", exc_info=True)
     if settings.SENTRY_DSN:
+        import sentry_sdk
         sentry_sdk.capture_exception(exc)
     
     return JSONResponse(
@@ -145,14 +264,18 @@ async def general_exception_handler(request: Request, exc: Exception):
     )
 
 # Include routers with proper dependencies
-app.include_router(auth.router, prefix="/api/v1/auth", tags=["authentication"])
-app.include_router(transactions.router, prefix="/api/v1/transactions", tags=["transactions"])
-app.include_router(documents.router, prefix="/api/v1/documents", tags=["documents"])
-app.include_router(reports.router, prefix="/api/v1/reports", tags=["reports"])
-app.include_router(ai.router, prefix="/api/v1/ai", tags=["ai"])
-app.include_router(bank.router, prefix="/api/v1/bank", tags=["bank"])
-app.include_router(tax.router, prefix="/api/v1/tax", tags=["tax"])
-app.include_router(analytics.router, prefix="/api/v1/analytics", tags=["analytics"])
+def register_routers(app: FastAPI):
+    """Import and mount the API v1 routers"""
+    from app.api.v1 import auth, transactions, documents, reports, ai, bank, tax, analytics
+    
+    app.include_router(auth.router, prefix="/api/v1/auth", tags=["authentication"])
+    app.include_router(transactions.router, prefix="/api/v1/transactions", tags=["transactions"])
+    app.include_router(documents.router, prefix="/api/v1/documents", tags=["documents"])
+    app.include_router(reports.router, prefix="/api/v1/reports", tags=["reports"])
+    app.include_router(ai.router, prefix="/api/v1/ai", tags=["ai"])
+    app.include_router(bank.router, prefix="/api/v1/bank", tags=["bank"])
+    app.include_router(tax.router, prefix="/api/v1/tax", tags=["tax"])
+    app.include_router(analytics.router, prefix="/api/v1/analytics", tags=["analytics"])
 
 # WebSocket endpoints
 @app.websocket("/ws")
@@ -164,99 +287,123 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
 # Metrics endpoint
+_metrics_cache = {"body": b"", "expires": 0.0}
+_metrics_lock = asyncio.Lock()
+
 @app.get("/metrics")
 async def metrics():
-    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+    """Prometheus exposition, serialized off the event loop and cached briefly"""
+    async with _metrics_lock:
+        now = time.monotonic()
+        if now >= _metrics_cache["expires"]:
+            _metrics_cache["body"] = await asyncio.to_thread(generate_latest)
+            _metrics_cache["expires"] = now + settings.METRICS_CACHE_TTL
+        body = _metrics_cache["body"]
+    return Response(body, media_type=CONTENT_TYPE_LATEST)
 
-@app.middleware("http")
-async def add_process_time_header(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    
-    response.headers["X-Process-Time"] = str(process_time)
-    
-    # Record metrics
-    REQUEST_COUNT.labels(
-        method=request.method,
-        endpoint=request.url.path,
-        status=response.status_code
-    ).inc()
-    
-    REQUEST_LATENCY.labels(endpoint=request.url.path).observe(process_time)
-    
-    return response
+# Everything but the uptime is fixed after boot: serialize it once and leave
+# the closing brace off so the uptime can be appended per request
+_ROOT_PREFIX = orjson.dumps({
+    "app": settings.APP_NAME,
+    "version": settings.APP_VERSION,
+    "environment": settings.ENVIRONMENT,
+    "status": "running",
+    "docs": "/api/docs" if settings.DEBUG else None,
+})[:-1] + b',"uptime":'
+
+# Fallback for when lifespan has not run (e.g. TestClient without a context manager)
+_PROCESS_START = time.monotonic()
 
 @app.get("/")
 async def root():
     """Root endpoint"""
-    return {
-        "app": settings.APP_NAME,
-        "version": settings.APP_VERSION,
-        "environment": settings.ENVIRONMENT,
-        "status": "running",
-        "docs": "/api/docs" if settings.DEBUG else None,
-        "uptime": time.time() - app.state.start_time if hasattr(app.state, 'start_time') else 0
-    }
+    uptime = time.monotonic() - getattr(app.state, "start_time", _PROCESS_START)
+    return Response(content=_ROOT_PREFIX + repr(uptime).encode() + b"}", media_type="application/json")
+
+# Dedicated probe connections, so health checks never compete with request
+# traffic for the main pool
+probe_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=2,
+    max_overflow=0,
+    pool_pre_ping=False,
+)
+
+HEALTH_CACHE_TTL = 5  # seconds
+_health_cache = {"body": None, "expires": 0.0}
+_health_lock = asyncio.Lock()
+
+async def _check_database():
+    async with probe_engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
 
 @app.get("/health")
-async def health_check(db=Depends(get_db)):
-    """Comprehensive health check"""
-    health_status = {
-        "status": "healthy",
-        "timestamp": time.time(),
-        "services": {}
+async def health_check():
+    """Comprehensive health check (concurrent probes share one cached result)"""
+    async with _health_lock:
+        if time.monotonic() < _health_cache["expires"]:
+            return _health_cache["body"]
+        
+        health_status = {
+            "status": "healthy",
+            "timestamp": time.time(),
+            "services": {}
+        }
+        
+        # Check database
+        try:
+            await asyncio.wait_for(_check_database(), timeout=1.0)
+            health_status["services"]["database"] = "connected"
+        except Exception as e:
+            health_status["services"]["database"] = f"error: {str(e)}"
+            health_status["status"] = "degraded"
+        
+        # Check Redis
+        try:
+            await asyncio.wait_for(redis_client.ping(), timeout=1.0)
+            health_status["services"]["redis"] = "connected"
+        except Exception as e:
+            health_status["services"]["redis"] = f"error: {str(e)}"
+            health_status["status"] = "degraded"
+        
+        # Check external services
+        if settings.OPENAI_API_KEY:
+            health_status["services"]["openai"] = "configured"
+        
+        if settings.PLAID_CLIENT_ID and settings.PLAID_SECRET:
+            health_status["services"]["plaid"] = "configured"
+        
+        _health_cache["body"] = health_status
+        _health_cache["expires"] = time.monotonic() + HEALTH_CACHE_TTL
+        return health_status
+
+# The frontend config only depends on frozen settings, so it is serialized
+# once at import instead of on every request
+_CONFIG_BODY = orjson.dumps({
+    "api_url": "/api/v1",
+    "ws_url": settings.WS_URL,
+    "environment": settings.ENVIRONMENT,
+    "features": {
+        "ai_categorization": True,
+        "bank_sync": bool(settings.PLAID_CLIENT_ID),
+        "tax_optimization": True,
+        "realtime_updates": True,
+        "multi_company": True,
+        "collaboration": True,
+    },
+    "limits": {
+        "max_upload_size": settings.MAX_UPLOAD_SIZE,
+        "max_documents": 1000,
+        "max_transactions": 10000,
     }
-    
-    # Check database
-    try:
-        db.execute("SELECT 1")
-        health_status["services"]["database"] = "connected"
-    except Exception as e:
-        health_status["services"]["database"] = f"error: {str(e)}"
-        health_status["status"] = "degraded"
-    
-    # Check Redis
-    from app.database import redis_client
-    try:
-        redis_client.ping()
-        health_status["services"]["redis"] = "connected"
-    except Exception as e:
-        health_status["services"]["redis"] = f"error: {str(e)}"
-        health_status["status"] = "degraded"
-    
-    # Check external services
-    from app.core.config import settings
-    
-    if settings.OPENAI_API_KEY:
-        health_status["services"]["openai"] = "configured"
-    
-    if settings.PLAID_CLIENT_ID and settings.PLAID_SECRET:
-        health_status["services"]["plaid"] = "configured"
-    
-    return health_status
+})
 
 @app.get("/config")
 async def get_config(current_user=Depends(get_current_user)):
     """Get frontend configuration"""
-    return {
-        "api_url": "/api/v1",
-        "ws_url": f"ws://{settings.BACKEND_CORS_ORIGINS[0].split('://')[1]}/ws",
-        "environment": settings.ENVIRONMENT,
-        "features": {
-            "ai_categorization": True,
-            "bank_sync": bool(settings.PLAID_CLIENT_ID),
-            "tax_optimization": True,
-            "realtime_updates": True,
-            "multi_company": True,
-            "collaboration": True,
-        },
-        "limits": {
-            "max_upload_size": settings.MAX_UPLOAD_SIZE,
-            "max_documents": 1000,
-            "max_transactions": 10000,
-        }
-    }
+    return Response(content=_CONFIG_BODY, media_type="application/json")
+
+register_routers(app)
 
 if __name__ == "__main__":
     import uvicorn
@@ -265,7 +412,12 @@ if __name__ == "__main__":
         host="0.0.0.0",
         port=8000,
         reload=settings.DEBUG,
-        log_level="info",
+        log_level="warning",
         access_log=False,
-        proxy_headers=True,
+        proxy_headers=settings.ENVIRONMENT == "production",
+        loop="uvloop",
+        http="httptools",
+        server_header=False,
+        date_header=False,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
     )
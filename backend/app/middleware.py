@@ -0,0 +1,140 @@
+import logging
+import time
+
+from starlette.middleware.gzip import GZipMiddleware
+
+from app.database import redis_client
+
+logger = logging.getLogger(__name__)
+
+class RateLimitMiddleware:
+    """Pure ASGI fixed-window rate limiter backed by Redis"""
+
+    def __init__(self, app, limit: int = 100, window: int = 60):
+        self.app = app
+        self.limit = limit
+        self.window = window
+        self.redis = redis_client
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        client = scope.get("client")
+        ip = client[0] if client else "unknown"
+        window_bucket = int(time.time()) // self.window
+        key = f"rl:{ip}:{window_bucket}"
+
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.incr(key)
+                pipe.expire(key, self.window)
+                count, _ = await pipe.execute()
+        except Exception as e:
+            # Fail open: a Redis outage must not take the API down
+            logger.warning(f"Rate limiter unavailable: {e}")
+            return await self.app(scope, receive, send)
+
+        if count > self.limit:
+            retry_after = str(self.window - int(time.time()) % self.window).encode()
+            await send({
+                "type": "http.response.start",
+                "status": 429,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"retry-after", retry_after),
+                ],
+            })
+            await send({
+                "type": "http.response.body",
+                "body": b'{"detail":"Rate limit exceeded"}',
+            })
+            return
+
+        await self.app(scope, receive, send)
+
+class RequestLoggingMiddleware:
+    """Pure ASGI request logger"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            client = scope.get("client")
+            logger.info(
+                "%s %s %s %d %.2fms",
+                client[0] if client else "-",
+                scope["method"],
+                scope["path"],
+                status_code,
+                (time.perf_counter() - start) * 1000,
+            )
+
+class SelectiveGZipMiddleware:
+    """GZip responses, except static/upload mounts and already-compressed media"""
+
+    SKIP_PREFIXES = ("/uploads", "/static")
+    SKIP_CONTENT_TYPES = ("image/", "video/", "application/pdf", "application/zip")
+
+    def __init__(self, app, minimum_size: int = 4096):
+        self.app = app
+        self.gzip = GZipMiddleware(self._mark_binary, minimum_size=minimum_size)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.SKIP_PREFIXES):
+            return await self.app(scope, receive, send)
+
+        async def send_wrapper(message):
+            # Drop the marker _mark_binary added once GZipMiddleware has let the
+            # response through; "identity" is not a valid Content-Encoding to send
+            if message["type"] == "http.response.start":
+                headers = message.get("headers", [])
+                stripped = [
+                    (name, value) for name, value in headers
+                    if not (name.lower() == b"content-encoding" and value == b"identity")
+                ]
+                if len(stripped) != len(headers):
+                    message = {**message, "headers": stripped}
+            await send(message)
+
+        await self.gzip(scope, receive, send_wrapper)
+
+    async def _mark_binary(self, scope, receive, send):
+        """Run the app, labelling compressed media as content-encoding: identity
+
+        GZipMiddleware passes any response that already carries a
+        content-encoding header through untouched, so this is decided on the
+        actual response content type rather than guessed from the path. The
+        label is internal only; __call__ removes it before the client sees it.
+        """
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = message.get("headers", [])
+                content_type = b""
+                has_encoding = False
+                for name, value in headers:
+                    name = name.lower()
+                    if name == b"content-type":
+                        content_type = value
+                    elif name == b"content-encoding":
+                        has_encoding = True
+                if not has_encoding and content_type.decode("latin-1").startswith(self.SKIP_CONTENT_TYPES):
+                    message = {**message, "headers": [*headers, (b"content-encoding", b"identity")]}
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
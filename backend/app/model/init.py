@@ -4,20 +4,41 @@ from sqlalchemy.sql import func
 from enum import Enum
 import uuid
 from datetime import datetime
+import importlib
 
 Base = declarative_base()
 
-# Import all models
-from .user import User, Company, CompanyUser, UserSession, UserPreference
-from .transaction import Transaction, TransactionTag, TransactionAttachment, TransactionComment
-from .document import Document, BankAccount, BankTransaction, BankConnection
-from .report import Report, ReportSchedule, ReportTemplate
-from .tax import TaxRecord, TaxCategory, TaxDeduction, TaxForm
-from .analytics import Dashboard, Widget, UserActivity, SystemMetric
-from .ai import AIModel, AITrainingData, AIResult
-from .workflow import Workflow, WorkflowStep, WorkflowExecution
-from .notification import Notification, NotificationTemplate, UserNotification
-from .integration import Integration, IntegrationLog, Webhook
+# Models are imported lazily (PEP 562) on first attribute access, so importing
+# the package does not pull in every model module up front
+_MODEL_MODULES = {
+    "User": "user", "Company": "user", "CompanyUser": "user", "UserSession": "user", "UserPreference": "user",
+    "Transaction": "transaction", "TransactionTag": "transaction", "TransactionAttachment": "transaction", "TransactionComment": "transaction",
+    "Document": "document", "BankAccount": "document", "BankTransaction": "document", "BankConnection": "document",
+    "Report": "report", "ReportSchedule": "report", "ReportTemplate": "report",
+    "TaxRecord": "tax", "TaxCategory": "tax", "TaxDeduction": "tax", "TaxForm": "tax",
+    "Dashboard": "analytics", "Widget": "analytics", "UserActivity": "analytics", "SystemMetric": "analytics",
+    "AIModel": "ai", "AITrainingData": "ai", "AIResult": "ai",
+    "Workflow": "workflow", "WorkflowStep": "workflow", "WorkflowExecution": "workflow",
+    "Notification": "notification", "NotificationTemplate": "notification", "UserNotification": "notification",
+    "Integration": "integration", "IntegrationLog": "integration", "Webhook": "integration",
+}
+
+def __getattr__(name):
+    module_name = _MODEL_MODULES.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    
+    value = getattr(importlib.import_module(f".{module_name}", __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals()) + list(_MODEL_MODULES))
+
+def import_all_models():
+    """Import every model module so all tables are registered on Base.metadata"""
+    for module_name in set(_MODEL_MODULES.values()):
+        importlib.import_module(f".{module_name}", __name__)
 
 __all__ = [
     "Base",
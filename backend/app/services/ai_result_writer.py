@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from typing import List, Optional
+
+from app.database import AsyncSessionLocal
+from app.models.ai import AIResult
+
+logger = logging.getLogger(__name__)
+
+class AIResultWriter:
+    """Persist AI results in batches from a single background task shared by all AIService instances
+
+    Batching only happens while the app lifespan has the writer started;
+    anywhere else (celery workers, scripts) results are written inline.
+    """
+
+    def __init__(self, batch_size: int = 100, flush_interval: float = 0.05):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval  # seconds
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self):
+        """Start the writer task on the running loop (called from the app lifespan)"""
+        if self._task is not None and not self._task.done():
+            return
+        # Created here so the queue belongs to the lifespan's loop
+        self._queue = asyncio.Queue()
+        self._loop = asyncio.get_running_loop()
+        self._task = self._loop.create_task(self._run())
+
+    async def save(self, ai_result: AIResult):
+        """Queue a result when the writer is running, otherwise write it now"""
+        if (
+            self._task is not None
+            and not self._task.done()
+            and self._loop is asyncio.get_running_loop()
+        ):
+            self._queue.put_nowait(ai_result)
+        else:
+            await self._commit([ai_result])
+
+    async def close(self):
+        """Write everything still queued, then stop the writer task"""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+        self._queue = None
+        self._loop = None
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+
+            # Collect whatever else arrives within the flush window
+            deadline = asyncio.get_running_loop().time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._commit(batch)
+
+    async def _commit(self, batch: List[AIResult]):
+        async with AsyncSessionLocal() as db:
+            try:
+                db.add_all(batch)
+                await db.commit()
+                return
+            except Exception as e:
+                await db.rollback()
+                if len(batch) == 1:
+                    logger.error(f"Failed to save AI result: {e}")
+                    return
+                logger.warning(f"Failed to save {len(batch)} AI results, retrying one by one: {e}")
+
+        # One bad row must not cost the rest of the batch
+        for ai_result in batch:
+            await self._commit([ai_result])
+
+ai_result_writer = AIResultWriter()
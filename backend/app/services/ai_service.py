@@ -1,47 +1,222 @@
 import logging
 from typing import Dict, List, Optional, Any, Tuple
 from datetime import datetime, timedelta
+from functools import lru_cache
+from types import MappingProxyType
 import asyncio
+import hashlib
 import json
+import uuid
+import os
 import numpy as np
 from openai import AsyncOpenAI, OpenAI
 import anthropic
 import cohere
 from tenacity import retry, stop_after_attempt, wait_exponential
-import redis
-import pickle
+import msgpack
+import orjson
+from sqlalchemy import and_, or_, select
 
 from app.core.config import settings
-from app.database import get_db, redis_client
+from app.database import AsyncSessionLocal, get_db, redis_client
+from app.services.ai_result_writer import ai_result_writer
 from app.models.transaction import Transaction
 from app.models.document import Document
 from app.models.ai import AIModel, AIResult
 
+try:
+    import ahocorasick
+except ImportError:  # optional: falls back to a precomputed keyword scan
+    ahocorasick = None
+
 logger = logging.getLogger(__name__)
 
+# Delete the stampede lock only if it still holds this caller's token, so a
+# slow caller whose lock expired cannot release a lock someone else now owns
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+_SUBCATEGORY_MAP = MappingProxyType({
+    "meals": ["business_lunch", "team_dinner", "coffee_meeting", "client_entertainment"],
+    "travel": ["airfare", "hotel", "rental_car", "taxi", "meals_per_diem"],
+    "office": ["supplies", "equipment", "software", "furniture", "internet"],
+    "advertising": ["digital_ads", "social_media", "print_ads", "seo", "influencer"],
+    "subscriptions": ["saas", "cloud_services", "membership", "software"],
+    "utilities": ["electricity", "water", "internet", "phone", "gas"],
+    "professional": ["legal", "accounting", "consulting", "design"],
+    "shipping": ["postage", "courier", "delivery", "packaging"],
+    "insurance": ["liability", "health", "property", "workers_comp"],
+    "maintenance": ["repairs", "cleaning", "equipment_service"],
+    "payroll": ["salaries", "benefits", "bonuses", "contractors"],
+    "rent": ["office_rent", "equipment_rental", "storage"],
+    "entertainment": ["client_gifts", "event_tickets", "corporate_events"],
+    "education": ["training", "courses", "books", "conferences"],
+})
+
+_TAX_RULES = MappingProxyType({
+    category: MappingProxyType(rule) for category, rule in {
+        "meals": {"deductible": True, "rate": 0.5, "limit": None},
+        "travel": {"deductible": True, "rate": 1.0, "limit": None},
+        "office": {"deductible": True, "rate": 1.0, "limit": None},
+        "advertising": {"deductible": True, "rate": 1.0, "limit": None},
+        "subscriptions": {"deductible": True, "rate": 1.0, "limit": None},
+        "utilities": {"deductible": True, "rate": 1.0, "limit": None},
+        "professional": {"deductible": True, "rate": 1.0, "limit": None},
+        "shipping": {"deductible": True, "rate": 1.0, "limit": None},
+        "insurance": {"deductible": True, "rate": 1.0, "limit": None},
+        "maintenance": {"deductible": True, "rate": 1.0, "limit": None},
+        "payroll": {"deductible": True, "rate": 1.0, "limit": None},
+        "rent": {"deductible": True, "rate": 1.0, "limit": None},
+        "entertainment": {"deductible": False, "rate": 0.0, "limit": None},
+        "education": {"deductible": True, "rate": 1.0, "limit": 5250},
+        "uncategorized": {"deductible": False, "rate": 0.0, "limit": None},
+    }.items()
+})
+_DEFAULT_TAX = MappingProxyType({"deductible": False, "rate": 0.0, "limit": None})
+
+_ACCOUNT_MAP = MappingProxyType({
+    "meals": "6060 - Meals & Entertainment",
+    "travel": "6070 - Travel Expenses",
+    "office": "6010 - Office Expenses",
+    "advertising": "6020 - Advertising",
+    "subscriptions": "6030 - Software & Subscriptions",
+    "utilities": "6040 - Utilities",
+    "professional": "6050 - Professional Fees",
+    "shipping": "6080 - Shipping & Delivery",
+    "insurance": "6090 - Insurance",
+    "maintenance": "6100 - Repairs & Maintenance",
+    "payroll": "5010 - Salaries & Wages",
+    "rent": "6110 - Rent Expense",
+    "entertainment": "6120 - Entertainment",
+    "education": "6130 - Training & Education",
+    "uncategorized": "6999 - Miscellaneous Expense",
+})
+_DEFAULT_ACCOUNT = "6999 - Miscellaneous Expense"
+
+# Provider weights for ensemble voting (the last slot is for unknown providers)
+_PROVIDER_IDX = MappingProxyType({"openai": 0, "anthropic": 1, "cohere": 2, "local_ml": 3})
+_UNKNOWN_PROVIDER_IDX = len(_PROVIDER_IDX)
+_PROVIDER_WEIGHTS = np.array([0.4, 0.3, 0.2, 0.1, 0.1])
+
+_CATEGORIES = tuple(_ACCOUNT_MAP)
+_CATEGORY_IDX = MappingProxyType({category: i for i, category in enumerate(_CATEGORIES)})
+
+# Shared categorization prompt: the category list lives in the (cacheable)
+# system prompt and the answer is forced through a tool whose schema enumerates
+# the categories, so the per-transaction message only carries the transaction
+_CATEGORY_DESCRIPTIONS = MappingProxyType({
+    "meals": "Restaurant, food, coffee, business meals",
+    "travel": "Flights, hotels, transportation",
+    "office": "Office supplies, equipment, software",
+    "advertising": "Marketing, ads, promotions",
+    "subscriptions": "SaaS, software subscriptions",
+    "utilities": "Electricity, internet, phone",
+    "professional": "Legal, accounting, consulting",
+    "shipping": "Postage, delivery, shipping",
+    "insurance": "Business insurance",
+    "maintenance": "Repairs, maintenance",
+    "payroll": "Employee salaries, benefits",
+    "rent": "Office rent, equipment rental",
+    "entertainment": "Client entertainment",
+    "education": "Training, courses, books",
+    "uncategorized": "Unknown or other",
+})
+
+_CATEGORIZATION_SYSTEM_PROMPT = (
+    "You are a financial categorization expert. Categorize each business transaction "
+    "into one of these categories:\n"
+    + "\n".join(f"- {category}: {description}" for category, description in _CATEGORY_DESCRIPTIONS.items())
+    + "\nAlso provide the tax deductible status, a suggested subcategory and a confidence score (0-1)."
+)
+
+_CATEGORIZATION_TOOL_NAME = "categorize_transaction"
+_CATEGORIZATION_TOOL_DESCRIPTION = "Record the category of a business transaction"
+_CATEGORIZATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "category": {"type": "string", "enum": list(_CATEGORY_DESCRIPTIONS)},
+        "subcategory": {"type": "string"},
+        "tax_deductible": {"type": "boolean"},
+        "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+        "reasoning": {"type": "string"},
+    },
+    "required": ["category", "tax_deductible", "confidence"],
+}
+
+def _categorization_message(description: str, merchant: str, amount: float = None) -> str:
+    return f"Description: {description}\nMerchant: {merchant}\nAmount: ${amount if amount else 'N/A'}"
+
+# Category model stored as raw arrays for a HashingVectorizer pipeline: no
+# vocabulary to rebuild and no pickle to execute, and the coefficient matrix is
+# memory-mapped so it is paged in lazily and shared between workers
+HASHED_MODEL_DIR = 'ml/models/category_classifier'
+
+def export_hashed_category_model(directory: str, classifier, idf: np.ndarray, n_features: int):
+    """Write a classifier trained on HashingVectorizer(n_features, alternate_sign=False) + TF-IDF"""
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, 'coef.npy'), classifier.coef_)
+    np.save(os.path.join(directory, 'intercept.npy'), classifier.intercept_)
+    np.save(os.path.join(directory, 'classes.npy'), np.asarray(classifier.classes_, dtype=str))
+    np.save(os.path.join(directory, 'idf.npy'), idf)
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump({"n_features": n_features}, f)
+
+def _load_hashed_category_model(directory: str) -> Dict[str, Any]:
+    from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+    
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+    
+    tfidf = TfidfTransformer()
+    tfidf.idf_ = np.load(os.path.join(directory, 'idf.npy'))
+    vectorizer = make_pipeline(
+        HashingVectorizer(n_features=meta["n_features"], alternate_sign=False, norm=None),
+        tfidf,
+    )
+    
+    classifier = LogisticRegression()
+    classifier.coef_ = np.load(os.path.join(directory, 'coef.npy'), mmap_mode='r')
+    classifier.intercept_ = np.load(os.path.join(directory, 'intercept.npy'))
+    classifier.classes_ = np.load(os.path.join(directory, 'classes.npy'))
+    
+    return {'category_classifier': classifier, 'vectorizer': vectorizer}
+
 class AIService:
     """Complete AI service with multiple providers and caching"""
     
     def __init__(self):
         self.openai_client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY) if settings.OPENAI_API_KEY else None
-        self.anthropic_client = anthropic.Client(api_key=settings.ANTHROPIC_API_KEY) if settings.ANTHROPIC_API_KEY else None
-        self.cohere_client = cohere.Client(api_key=settings.COHERE_API_KEY) if settings.COHERE_API_KEY else None
+        self.anthropic_client = anthropic.AsyncAnthropic(api_key=settings.ANTHROPIC_API_KEY) if settings.ANTHROPIC_API_KEY else None
+        self.cohere_client = cohere.AsyncClient(api_key=settings.COHERE_API_KEY) if settings.COHERE_API_KEY else None
         
         self.cache = redis_client
         self.cache_prefix = "ai:"
         self.cache_ttl = 3600  # 1 hour
+        self.lock_ttl = 30  # seconds a categorization lock is held at most
         
         # Load local ML models
         self.local_models = self.load_local_models()
         
+        self._build_subcategory_index()
+        
     def load_local_models(self) -> Dict[str, Any]:
         """Load local ML models"""
         models = {}
         try:
-            # Load category classifier
-            import joblib
-            models['category_classifier'] = joblib.load('ml/models/category_classifier.pkl')
-            models['vectorizer'] = joblib.load('ml/models/tfidf_vectorizer.pkl')
+            if os.path.isdir(HASHED_MODEL_DIR):
+                models.update(_load_hashed_category_model(HASHED_MODEL_DIR))
+            else:
+                # Load category classifier; numpy arrays are memory-mapped read-only
+                # so every worker shares the same page-cache copy
+                import joblib
+                models['category_classifier'] = joblib.load('ml/models/category_classifier.pkl', mmap_mode='r')
+                models['vectorizer'] = joblib.load('ml/models/tfidf_vectorizer.pkl', mmap_mode='r')
             logger.info("Local ML models loaded successfully")
         except Exception as e:
             logger.warning(f"Failed to load local models: {e}")
@@ -50,14 +225,99 @@ class AIService:
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
     async def categorize_transaction(self, transaction_data: Dict[str, Any], user_id: str) -> Dict[str, Any]:
         """Categorize transaction using ensemble AI approach"""
-        cache_key = f"{self.cache_prefix}categorize:{user_id}:{hash(str(transaction_data))}"
+        cache_key = self._categorize_cache_key(transaction_data, user_id)
+        
+        if not settings.CACHE_ENABLED:
+            return await self._categorize_fresh(transaction_data, user_id)
         
         # Check cache
-        if settings.CACHE_ENABLED:
+        cached = await self.cache.get(cache_key)
+        if cached:
+            return self._result_from_cache(cached, transaction_data, user_id)
+        
+        # Stampede guard: only one caller across all workers runs the ensemble
+        # for a given key; the others wait for its cached result
+        lock_key = f"lock:{cache_key}"
+        lock_token = uuid.uuid4().hex
+        lock_acquired = await self.cache.set(lock_key, lock_token, nx=True, ex=self.lock_ttl)
+        if not lock_acquired:
+            cached = await self._wait_for_cache(cache_key)
+            if cached:
+                return self._result_from_cache(cached, transaction_data, user_id)
+        
+        try:
+            result = await self._categorize_fresh(transaction_data, user_id)
+            
+            # Cache result
+            await self.cache.setex(cache_key, self.cache_ttl, self._cache_entry(result))
+        finally:
+            if lock_acquired:
+                await self.cache.eval(_RELEASE_LOCK_SCRIPT, 1, lock_key, lock_token)
+        
+        return result
+    
+    async def _categorize_fresh(self, transaction_data: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+        local_result = self._categorize_local(
+            transaction_data.get('description', ''),
+            transaction_data.get('merchant', '')
+        )
+        return await self._categorize_uncached(transaction_data, user_id, local_result)
+    
+    async def _wait_for_cache(self, cache_key: str) -> Optional[bytes]:
+        """Poll for a result another worker is computing, with exponential backoff up to the lock TTL"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.lock_ttl
+        delay = 0.05
+        while loop.time() < deadline:
+            await asyncio.sleep(delay)
             cached = await self.cache.get(cache_key)
             if cached:
-                return pickle.loads(cached)
+                return cached
+            delay = min(delay * 2, 2.0)
+        return None
+    
+    async def categorize_transactions_batch(self, transactions: List[Dict[str, Any]], user_id: str) -> List[Dict[str, Any]]:
+        """Categorize many transactions, running the local model once over the whole batch"""
+        cache_keys = [self._categorize_cache_key(txn, user_id) for txn in transactions]
+        results = [None] * len(transactions)
+        
+        # Check cache (one MGET round trip for the whole batch)
+        if settings.CACHE_ENABLED and cache_keys:
+            cached_values = await self.cache.mget(cache_keys)
+            for i, cached in enumerate(cached_values):
+                if cached:
+                    results[i] = self._result_from_cache(cached, transactions[i], user_id)
+        
+        misses = [i for i, result in enumerate(results) if result is None]
+        if not misses:
+            return results
+        
+        # One vectorizer/classifier pass for every uncached transaction
+        local_results = self._categorize_local_batch([
+            (transactions[i].get('description', ''), transactions[i].get('merchant', ''))
+            for i in misses
+        ])
+        
+        # Remote providers are still queried per transaction, concurrently
+        computed = await asyncio.gather(*(
+            self._categorize_uncached(transactions[i], user_id, local_result)
+            for i, local_result in zip(misses, local_results)
+        ))
+        for i, result in zip(misses, computed):
+            results[i] = result
+        
+        # Cache results (one pipelined round trip)
+        if settings.CACHE_ENABLED:
+            async with self.cache.pipeline(transaction=False) as pipe:
+                for i in misses:
+                    pipe.setex(cache_keys[i], self.cache_ttl, self._cache_entry(results[i]))
+                await pipe.execute()
         
+        return results
+    
+    async def _categorize_uncached(self, transaction_data: Dict[str, Any], user_id: str,
+                                   local_result: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """Run the provider ensemble for a cache miss and persist the result"""
         # Prepare inputs
         description = transaction_data.get('description', '')
         merchant = transaction_data.get('merchant', '')
@@ -67,171 +327,176 @@ class AIService:
         results = []
         
         # 1. Local ML model
-        local_result = self._categorize_local(description, merchant)
         if local_result:
             results.append(local_result)
         
-        # 2. OpenAI
-        if self.openai_client:
-            try:
-                openai_result = await self._categorize_openai(description, merchant, amount)
-                results.append(openai_result)
-            except Exception as e:
-                logger.error(f"OpenAI categorization failed: {e}")
-        
-        # 3. Anthropic
-        if self.anthropic_client:
-            try:
-                anthropic_result = await self._categorize_anthropic(description, merchant, amount)
-                results.append(anthropic_result)
-            except Exception as e:
-                logger.error(f"Anthropic categorization failed: {e}")
-        
-        # 4. Cohere
-        if self.cohere_client:
-            try:
-                cohere_result = await self._categorize_cohere(description, merchant)
-                results.append(cohere_result)
-            except Exception as e:
-                logger.error(f"Cohere categorization failed: {e}")
+        # Skip the remote providers when the local model is already confident
+        shortcut = bool(local_result) and local_result["confidence"] >= settings.LOCAL_CONFIDENCE_SHORTCUT
+        
+        # 2-4. Remote providers, queried concurrently
+        providers = []
+        if not shortcut:
+            if self.openai_client:
+                providers.append(("OpenAI", self._categorize_openai(description, merchant, amount)))
+            if self.anthropic_client:
+                providers.append(("Anthropic", self._categorize_anthropic(description, merchant, amount)))
+            if self.cohere_client:
+                providers.append(("Cohere", self._categorize_cohere(description, merchant)))
+        
+        provider_results = await asyncio.gather(*(call for _, call in providers), return_exceptions=True)
+        for (name, _), provider_result in zip(providers, provider_results):
+            if isinstance(provider_result, Exception):
+                logger.error(f"{name} categorization failed: {provider_result}")
+            elif provider_result:
+                results.append(provider_result)
         
         # Ensemble voting
         final_category, confidence = self._ensemble_vote(results)
+        result = self._build_result(final_category, confidence, results, transaction_data, user_id, shortcut)
+        
+        # Save to database (batched in the background)
+        await self._save_ai_result(user_id, "categorization", result, transaction_data)
         
+        return result
+    
+    def _build_result(self, category: str, confidence: float, sources: List[Dict[str, Any]],
+                      transaction_data: Dict[str, Any], user_id: str, shortcut: bool = False) -> Dict[str, Any]:
+        """Add the fields derived from the category to an ensemble outcome"""
         # Get subcategory and tax info
-        subcategory = self._get_subcategory(final_category, description)
-        tax_info = self._get_tax_info(final_category, amount, user_id)
+        subcategory = self._get_subcategory(category, transaction_data.get('description', ''))
+        tax_info = self._get_tax_info(category, transaction_data.get('amount'), user_id)
         
-        result = {
-            "category": final_category,
+        return {
+            "category": category,
             "subcategory": subcategory,
             "confidence": confidence,
             "tax_deductible": tax_info.get('deductible', False),
             "tax_rate": tax_info.get('rate', 0.0),
-            "suggested_account": self._get_suggested_account(final_category),
+            "suggested_account": self._get_suggested_account(category),
             "needs_review": confidence < 0.8,
-            "sources": results
+            "shortcut": shortcut,
+            "sources": sources
         }
-        
-        # Cache result
-        if settings.CACHE_ENABLED:
-            await self.cache.setex(cache_key, self.cache_ttl, pickle.dumps(result))
-        
-        # Save to database
-        await self._save_ai_result(user_id, "categorization", result, transaction_data)
-        
-        return result
+    
+    def _cache_entry(self, result: Dict[str, Any]) -> bytes:
+        """Only the expensive ensemble outcome is cached; derived fields are recomputed on read"""
+        return msgpack.packb({
+            "category": result["category"],
+            "confidence": result["confidence"],
+            "shortcut": result["shortcut"],
+            "sources": result["sources"],
+        }, use_bin_type=True)
+    
+    def _result_from_cache(self, cached: bytes, transaction_data: Dict[str, Any], user_id: str) -> Dict[str, Any]:
+        entry = msgpack.unpackb(cached, raw=False)
+        return self._build_result(entry["category"], entry["confidence"], entry["sources"],
+                                  transaction_data, user_id, entry.get("shortcut", False))
+    
+    def _categorize_cache_key(self, transaction_data: Dict[str, Any], user_id: str) -> str:
+        """Stable cache key, identical across workers for the same transaction"""
+        key_bytes = orjson.dumps(transaction_data, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS, default=str)
+        digest = hashlib.blake2b(key_bytes, digest_size=16).hexdigest()
+        return f"{self.cache_prefix}categorize:{user_id}:{digest}"
     
     def _categorize_local(self, description: str, merchant: str) -> Dict[str, Any]:
         """Categorize using local ML model"""
+        return self._categorize_local_batch([(description, merchant)])[0]
+    
+    def _categorize_local_batch(self, items: List[Tuple[str, str]]) -> List[Optional[Dict[str, Any]]]:
+        """Categorize (description, merchant) pairs with one vectorize/predict call"""
+        results = [None] * len(items)
         if 'category_classifier' not in self.local_models:
-            return None
+            return results
         
         try:
             # Prepare text
-            text = f"{description} {merchant}".strip()
-            if not text:
-                return None
+            texts = [f"{description} {merchant}".strip() for description, merchant in items]
+            indices = [i for i, text in enumerate(texts) if text]
+            if not indices:
+                return results
             
             # Vectorize
-            vector = self.local_models['vectorizer'].transform([text])
+            vectors = self.local_models['vectorizer'].transform([texts[i] for i in indices])
             
             # Predict
-            prediction = self.local_models['category_classifier'].predict_proba(vector)[0]
-            predicted_idx = np.argmax(prediction)
-            confidence = prediction[predicted_idx]
+            classifier = self.local_models['category_classifier']
+            if hasattr(classifier, 'predict_proba'):
+                probabilities = classifier.predict_proba(vectors)
+                predicted_idx = np.argmax(probabilities, axis=1)
+                confidences = probabilities[np.arange(len(predicted_idx)), predicted_idx]
+            else:
+                # Margin-only models: softmax probability of the winning class,
+                # 1 / sum(exp(s - s_max)), over all classes rather than the runner-up
+                scores = classifier.decision_function(vectors)
+                if scores.ndim == 1:
+                    scores = np.column_stack([np.zeros_like(scores), scores])
+                predicted_idx = np.argmax(scores, axis=1)
+                shifted = scores - scores[np.arange(len(predicted_idx)), predicted_idx][:, None]
+                confidences = 1.0 / np.exp(shifted).sum(axis=1)
             
             # Get category names
-            categories = self.local_models['category_classifier'].classes_
-            category = categories[predicted_idx]
+            categories = classifier.classes_[predicted_idx]
             
-            return {
-                "provider": "local_ml",
-                "category": category,
-                "confidence": float(confidence),
-                "model": "category_classifier"
-            }
+            for i, category, confidence in zip(indices, categories, confidences):
+                results[i] = {
+                    "provider": "local_ml",
+                    "category": str(category),
+                    "confidence": float(confidence),
+                    "model": "category_classifier"
+                }
         except Exception as e:
             logger.error(f"Local model categorization failed: {e}")
-            return None
+        
+        return results
     
     async def _categorize_openai(self, description: str, merchant: str, amount: float = None) -> Dict[str, Any]:
         """Categorize using OpenAI"""
-        prompt = f"""
-        Analyze this business transaction and categorize it:
-        
-        Description: {description}
-        Merchant: {merchant}
-        Amount: ${amount if amount else 'N/A'}
-        
-        Choose from these categories:
-        1. meals - Restaurant, food, coffee, business meals
-        2. travel - Flights, hotels, transportation
-        3. office - Office supplies, equipment, software
-        4. advertising - Marketing, ads, promotions
-        5. subscriptions - SaaS, software subscriptions
-        6. utilities - Electricity, internet, phone
-        7. professional - Legal, accounting, consulting
-        8. shipping - Postage, delivery, shipping
-        9. insurance - Business insurance
-        10. maintenance - Repairs, maintenance
-        11. payroll - Employee salaries, benefits
-        12. rent - Office rent, equipment rental
-        13. entertainment - Client entertainment
-        14. education - Training, courses, books
-        15. uncategorized - Unknown or other
-        
-        Also provide:
-        - Tax deductible status (true/false)
-        - Suggested subcategory
-        - Confidence score (0-1)
-        
-        Return as JSON with keys: category, subcategory, tax_deductible, confidence, reasoning
-        """
-        
         response = await self.openai_client.chat.completions.create(
             model="gpt-4-turbo-preview",
             messages=[
-                {"role": "system", "content": "You are a financial categorization expert. Return valid JSON only."},
-                {"role": "user", "content": prompt}
+                {"role": "system", "content": _CATEGORIZATION_SYSTEM_PROMPT},
+                {"role": "user", "content": _categorization_message(description, merchant, amount)}
             ],
             temperature=0.1,
-            response_format={"type": "json_object"}
+            tools=[{
+                "type": "function",
+                "function": {
+                    "name": _CATEGORIZATION_TOOL_NAME,
+                    "description": _CATEGORIZATION_TOOL_DESCRIPTION,
+                    "parameters": _CATEGORIZATION_SCHEMA,
+                }
+            }],
+            tool_choice={"type": "function", "function": {"name": _CATEGORIZATION_TOOL_NAME}},
         )
         
-        result = json.loads(response.choices[0].message.content)
+        result = orjson.loads(response.choices[0].message.tool_calls[0].function.arguments)
         result["provider"] = "openai"
         
         return result
     
     async def _categorize_anthropic(self, description: str, merchant: str, amount: float = None) -> Dict[str, Any]:
         """Categorize using Anthropic Claude"""
-        prompt = f"""
-        Human: Categorize this business transaction:
-        Description: {description}
-        Merchant: {merchant}
-        Amount: ${amount if amount else 'N/A'}
-        
-        Categories: meals, travel, office, advertising, subscriptions, utilities, professional, shipping, insurance, maintenance, payroll, rent, entertainment, education, uncategorized
-        
-        Return JSON with: category, subcategory, tax_deductible, confidence
-        
-        Assistant: {{
-        """
-        
-        response = self.anthropic_client.completions.create(
-            model="claude-2",
-            prompt=prompt,
-            max_tokens_to_sample=300,
+        response = await self.anthropic_client.messages.create(
+            model="claude-3-haiku-20240307",
+            system=_CATEGORIZATION_SYSTEM_PROMPT,
+            messages=[
+                {"role": "user", "content": _categorization_message(description, merchant, amount)}
+            ],
+            max_tokens=300,
             temperature=0.1,
+            tools=[{
+                "name": _CATEGORIZATION_TOOL_NAME,
+                "description": _CATEGORIZATION_TOOL_DESCRIPTION,
+                "input_schema": _CATEGORIZATION_SCHEMA,
+            }],
+            tool_choice={"type": "tool", "name": _CATEGORIZATION_TOOL_NAME},
         )
         
-        # Parse response (Claude doesn't have native JSON mode)
-        content = response.completion.strip()
-        try:
-            result = json.loads(content + "}")
-        except:
-            # Fallback parsing
+        tool_input = next((block.input for block in response.content if block.type == "tool_use"), None)
+        if tool_input is not None:
+            result = dict(tool_input)
+        else:
+            # Fallback if no tool call came back
             result = {
                 "category": "uncategorized",
                 "subcategory": None,
@@ -246,7 +511,7 @@ class AIService:
         """Categorize using Cohere"""
         text = f"{description} from {merchant}" if merchant else description
         
-        response = self.cohere_client.classify(
+        response = await self.cohere_client.classify(
             inputs=[text],
             model="embed-english-v2.0",
             preset="financial-categories"
@@ -258,7 +523,7 @@ class AIService:
                 "provider": "cohere",
                 "category": classification.prediction,
                 "confidence": float(classification.confidence),
-                "labels": classification.labels
+                "labels": {name: float(label.confidence) for name, label in classification.labels.items()}
             }
             return result
         
@@ -266,149 +531,110 @@ class AIService:
     
     def _ensemble_vote(self, results: List[Dict[str, Any]]) -> Tuple[str, float]:
         """Combine multiple AI predictions using weighted voting"""
-        if not results:
+        votes = [result for result in results if result.get("category")]
+        if not votes:
             return "uncategorized", 0.0
         
-        # Define provider weights
-        weights = {
-            "openai": 0.4,
-            "anthropic": 0.3,
-            "cohere": 0.2,
-            "local_ml": 0.1
-        }
-        
-        category_scores = {}
-        
-        for result in results:
-            provider = result.get("provider")
-            category = result.get("category")
-            confidence = result.get("confidence", 0.5)
-            
-            if not category:
-                continue
-            
-            weight = weights.get(provider, 0.1)
-            score = confidence * weight
-            
-            if category in category_scores:
-                category_scores[category] += score
-            else:
-                category_scores[category] = score
+        # Encode each vote as (category code, provider code, confidence);
+        # labels outside the known set get codes after the known categories
+        extra_categories = []
+        codes = np.empty(len(votes), dtype=np.intp)
+        providers = np.empty(len(votes), dtype=np.intp)
+        confidences = np.empty(len(votes), dtype=np.float64)
+        for i, result in enumerate(votes):
+            category = result["category"]
+            code = _CATEGORY_IDX.get(category)
+            if code is None:
+                if category not in extra_categories:
+                    extra_categories.append(category)
+                code = len(_CATEGORIES) + extra_categories.index(category)
+            codes[i] = code
+            providers[i] = _PROVIDER_IDX.get(result.get("provider"), _UNKNOWN_PROVIDER_IDX)
+            confidences[i] = float(result.get("confidence", 0.5))
+        
+        category_scores = np.bincount(
+            codes,
+            weights=confidences * _PROVIDER_WEIGHTS[providers],
+            minlength=len(_CATEGORIES) + len(extra_categories)
+        )
         
-        if not category_scores:
-            return "uncategorized", 0.0
+        # Normalize confidence to 0-1
+        total_score = category_scores.sum()
+        if total_score <= 0:
+            return votes[0]["category"], 0.0
         
         # Get best category
-        best_category = max(category_scores.items(), key=lambda x: x[1])
+        best = int(category_scores.argmax())
+        best_category = _CATEGORIES[best] if best < len(_CATEGORIES) else extra_categories[best - len(_CATEGORIES)]
         
-        # Normalize confidence to 0-1
-        total_score = sum(category_scores.values())
-        normalized_confidence = best_category[1] / total_score if total_score > 0 else 0.0
+        return best_category, float(category_scores[best] / total_score)
+    
+    def _build_subcategory_index(self):
+        """Precompute subcategory keywords and, if available, an Aho-Corasick matcher over them"""
+        self._subcat_index = {
+            category: [(subcat, tuple(subcat.split('_'))) for subcat in subcategories]
+            for category, subcategories in _SUBCATEGORY_MAP.items()
+        }
         
-        return best_category[0], normalized_confidence
+        self._keyword_automaton = None
+        if ahocorasick is not None:
+            automaton = ahocorasick.Automaton()
+            for entries in self._subcat_index.values():
+                for _, keywords in entries:
+                    for keyword in keywords:
+                        automaton.add_word(keyword, keyword)
+            automaton.make_automaton()
+            self._keyword_automaton = automaton
+        
+        self._match_subcategory = lru_cache(maxsize=4096)(self._match_subcategory_uncached)
     
     def _get_subcategory(self, category: str, description: str) -> str:
         """Get appropriate subcategory based on category and description"""
-        subcategory_map = {
-            "meals": ["business_lunch", "team_dinner", "coffee_meeting", "client_entertainment"],
-            "travel": ["airfare", "hotel", "rental_car", "taxi", "meals_per_diem"],
-            "office": ["supplies", "equipment", "software", "furniture", "internet"],
-            "advertising": ["digital_ads", "social_media", "print_ads", "seo", "influencer"],
-            "subscriptions": ["saas", "cloud_services", "membership", "software"],
-            "utilities": ["electricity", "water", "internet", "phone", "gas"],
-            "professional": ["legal", "accounting", "consulting", "design"],
-            "shipping": ["postage", "courier", "delivery", "packaging"],
-            "insurance": ["liability", "health", "property", "workers_comp"],
-            "maintenance": ["repairs", "cleaning", "equipment_service"],
-            "payroll": ["salaries", "benefits", "bonuses", "contractors"],
-            "rent": ["office_rent", "equipment_rental", "storage"],
-            "entertainment": ["client_gifts", "event_tickets", "corporate_events"],
-            "education": ["training", "courses", "books", "conferences"],
-        }
-        
-        subcategories = subcategory_map.get(category, [])
-        if not subcategories:
+        if category not in self._subcat_index:
             return None
+        # Descriptions repeat heavily (same merchants), so memoize the match
+        return self._match_subcategory(category, description.lower())
+    
+    def _match_subcategory_uncached(self, category: str, desc_lower: str) -> str:
+        entries = self._subcat_index[category]
         
         # Simple keyword matching for subcategory
-        desc_lower = description.lower()
-        for subcat in subcategories:
-            if any(keyword in desc_lower for keyword in subcat.split('_')):
-                return subcat
-        
-        return subcategories[0]  # Default first subcategory
+        if self._keyword_automaton is not None:
+            matched = {keyword for _, keyword in self._keyword_automaton.iter(desc_lower)}
+            for subcat, keywords in entries:
+                if not matched.isdisjoint(keywords):
+                    return subcat
+        else:
+            for subcat, keywords in entries:
+                if any(keyword in desc_lower for keyword in keywords):
+                    return subcat
+        
+        return entries[0][0]  # Default first subcategory
     
     def _get_tax_info(self, category: str, amount: float, user_id: str) -> Dict[str, Any]:
         """Get tax information for category"""
         # This would normally come from tax rules database
-        tax_rules = {
-            "meals": {"deductible": True, "rate": 0.5, "limit": None},
-            "travel": {"deductible": True, "rate": 1.0, "limit": None},
-            "office": {"deductible": True, "rate": 1.0, "limit": None},
-            "advertising": {"deductible": True, "rate": 1.0, "limit": None},
-            "subscriptions": {"deductible": True, "rate": 1.0, "limit": None},
-            "utilities": {"deductible": True, "rate": 1.0, "limit": None},
-            "professional": {"deductible": True, "rate": 1.0, "limit": None},
-            "shipping": {"deductible": True, "rate": 1.0, "limit": None},
-            "insurance": {"deductible": True, "rate": 1.0, "limit": None},
-            "maintenance": {"deductible": True, "rate": 1.0, "limit": None},
-            "payroll": {"deductible": True, "rate": 1.0, "limit": None},
-            "rent": {"deductible": True, "rate": 1.0, "limit": None},
-            "entertainment": {"deductible": False, "rate": 0.0, "limit": None},
-            "education": {"deductible": True, "rate": 1.0, "limit": 5250},
-            "uncategorized": {"deductible": False, "rate": 0.0, "limit": None},
-        }
-        
-        return tax_rules.get(category, {"deductible": False, "rate": 0.0, "limit": None})
+        return _TAX_RULES.get(category, _DEFAULT_TAX)
     
     def _get_suggested_account(self, category: str) -> str:
         """Get suggested GL account for category"""
-        account_map = {
-            "meals": "6060 - Meals & Entertainment",
-            "travel": "6070 - Travel Expenses",
-            "office": "6010 - Office Expenses",
-            "advertising": "6020 - Advertising",
-            "subscriptions": "6030 - Software & Subscriptions",
-            "utilities": "6040 - Utilities",
-            "professional": "6050 - Professional Fees",
-            "shipping": "6080 - Shipping & Delivery",
-            "insurance": "6090 - Insurance",
-            "maintenance": "6100 - Repairs & Maintenance",
-            "payroll": "5010 - Salaries & Wages",
-            "rent": "6110 - Rent Expense",
-            "entertainment": "6120 - Entertainment",
-            "education": "6130 - Training & Education",
-            "uncategorized": "6999 - Miscellaneous Expense",
-        }
-        
-        return account_map.get(category, "6999 - Miscellaneous Expense")
+        return _ACCOUNT_MAP.get(category, _DEFAULT_ACCOUNT)
     
     async def _save_ai_result(self, user_id: str, task_type: str, result: Dict[str, Any], input_data: Dict[str, Any]):
-        """Save AI result to database"""
-        from app.database import SessionLocal
-        
-        db = SessionLocal()
-        try:
-            ai_result = AIResult(
-                id=str(uuid.uuid4()),
-                user_id=user_id,
-                task_type=task_type,
-                input_data=json.dumps(input_data),
-                output_data=json.dumps(result),
-                model_used="ensemble",
-                confidence=result.get("confidence", 0.0),
-                cost_estimated=0.001,  # Estimate cost
-                processing_time=0.5,  # Estimate time
-                created_at=datetime.utcnow()
-            )
-            
-            db.add(ai_result)
-            db.commit()
-        except Exception as e:
-            logger.error(f"Failed to save AI result: {e}")
-            db.rollback()
-        finally:
-            db.close()
+        """Hand an AI result to the shared writer (batched in the app, written inline elsewhere)"""
+        ai_result = AIResult(
+            id=str(uuid.uuid4()),
+            user_id=user_id,
+            task_type=task_type,
+            input_data=orjson.dumps(input_data).decode(),
+            output_data=orjson.dumps(result).decode(),
+            model_used="ensemble",
+            confidence=result.get("confidence", 0.0),
+            cost_estimated=0.001,  # Estimate cost
+            processing_time=0.5,  # Estimate time
+            created_at=datetime.utcnow()
+        )
+        await ai_result_writer.save(ai_result)
     
     # Additional AI methods
     
@@ -420,19 +646,23 @@ class AIService:
         
         historical = await analytics.get_financial_history(user_id, months * 30)
         
-        # Simple prediction (replace with ML model)
-        predictions = []
-        last_amount = historical[-1]['amount'] if historical else 0
-        
-        for i in range(months):
-            # Simple linear regression prediction
-            predicted = last_amount * (1 + 0.05 * (i + 1))  # 5% growth assumption
-            predictions.append({
-                "month": i + 1,
-                "predicted_amount": predicted,
-                "confidence": 0.7 - (i * 0.1),  # Decreasing confidence
-                "factors": ["historical_trend", "seasonality", "growth_rate"]
-            })
+        # Simple prediction (replace with ML model; keep it array-in/array-out
+        # so a model's predict() output can slot in directly)
+        last_amount = float(historical[-1]['amount']) if historical else 0.0
+        month = np.arange(1, months + 1)
+        predicted = last_amount * (1 + 0.05 * month)  # 5% growth assumption
+        confidence = np.clip(0.7 - 0.1 * (month - 1), 0.0, 1.0)  # Decreasing confidence
+        
+        factors = ["historical_trend", "seasonality", "growth_rate"]
+        predictions = [
+            {
+                "month": m,
+                "predicted_amount": p,
+                "confidence": c,
+                "factors": factors
+            }
+            for m, p, c in zip(month.tolist(), predicted.tolist(), confidence.tolist())
+        ]
         
         return {
             "predictions": predictions,
@@ -443,48 +673,47 @@ class AIService:
     
     async def detect_anomalies(self, user_id: str) -> List[Dict[str, Any]]:
         """Detect anomalous transactions"""
-        from app.database import SessionLocal
+        # Simple anomaly detection (replace with ML); the rules are evaluated
+        # in SQL so only candidate rows are fetched, and only needed columns
+        query = select(Transaction.id, Transaction.amount, Transaction.description).where(
+            Transaction.user_id == user_id,
+            Transaction.created_at >= datetime.utcnow() - timedelta(days=90),
+            or_(
+                Transaction.amount > 10000,
+                and_(Transaction.amount >= 5000, Transaction.amount % 1000 == 0)
+            )
+        )
         
-        db = SessionLocal()
-        try:
-            # Get recent transactions
-            transactions = db.query(Transaction).filter(
-                Transaction.user_id == user_id,
-                Transaction.created_at >= datetime.utcnow() - timedelta(days=90)
-            ).all()
-            
-            anomalies = []
-            
-            # Simple anomaly detection (replace with ML)
-            for txn in transactions:
-                amount = float(txn.amount)
-                
-                # Check for unusually large amounts
-                if amount > 10000:
-                    anomalies.append({
-                        "transaction_id": txn.id,
-                        "type": "large_amount",
-                        "severity": "high",
-                        "amount": amount,
-                        "description": txn.description,
-                        "reason": f"Unusually large transaction: ${amount:,.2f}"
-                    })
-                
-                # Check for round amounts
-                if amount % 1000 == 0 and amount >= 5000:
-                    anomalies.append({
-                        "transaction_id": txn.id,
-                        "type": "round_amount",
-                        "severity": "medium",
-                        "amount": amount,
-                        "description": txn.description,
-                        "reason": f"Round amount transaction: ${amount:,.2f}"
-                    })
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(query)).all()
+        
+        anomalies = []
+        for row in rows:
+            amount = float(row.amount)
             
-            return anomalies
+            # Check for unusually large amounts
+            if amount > 10000:
+                anomalies.append({
+                    "transaction_id": row.id,
+                    "type": "large_amount",
+                    "severity": "high",
+                    "amount": amount,
+                    "description": row.description,
+                    "reason": f"Unusually large transaction: ${amount:,.2f}"
+                })
             
-        finally:
-            db.close()
+            # Check for round amounts
+            if amount % 1000 == 0 and amount >= 5000:
+                anomalies.append({
+                    "transaction_id": row.id,
+                    "type": "round_amount",
+                    "severity": "medium",
+                    "amount": amount,
+                    "description": row.description,
+                    "reason": f"Round amount transaction: ${amount:,.2f}"
+                })
+        
+        return anomalies
     
     async def generate_financial_insights(self, user_id: str) -> Dict[str, Any]:
         """Generate financial insights using AI"""
@@ -523,7 +752,7 @@ class AIService:
                 response_format={"type": "json_object"}
             )
             
-            return json.loads(response.choices[0].message.content)
+            return orjson.loads(response.choices[0].message.content)
         
         return {"insights": [], "recommendations": []}
     
@@ -545,7 +774,7 @@ class AIService:
             Estimated Tax: ${tax_data.get('estimated_tax', 0):,.2f}
             
             Deductions by Category:
-            {json.dumps(tax_data.get('deductions_by_category', {}), indent=2)}
+            {orjson.dumps(tax_data.get('deductions_by_category', {}), option=orjson.OPT_INDENT_2).decode()}
             
             Provide:
             1. Potential additional deductions
@@ -566,6 +795,6 @@ class AIService:
                 response_format={"type": "json_object"}
             )
             
-            return json.loads(response.choices[0].message.content)
+            return orjson.loads(response.choices[0].message.content)
         
         return {"suggestions": [], "estimated_savings": 0}
@@ -1,15 +1,93 @@
 import numpy as np
 import pandas as pd
 from sklearn.ensemble import IsolationForest
+from sklearn.ensemble._iforest import _average_path_length
 from sklearn.preprocessing import StandardScaler
+from sklearn.inspection import permutation_importance
 from sklearn.neighbors import LocalOutlierFactor
 from sklearn.svm import OneClassSVM
 import joblib
+import copy
 import json
-from datetime import datetime, timedelta
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
 import warnings
 warnings.filterwarnings('ignore')
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional; the NumPy kernel below is used instead
+    njit = None
+
+try:
+    import lz4  # only needed so joblib can use its lz4 compressor
+    MODEL_COMPRESSION = ('lz4', 1)
+except ImportError:  # lz4 is optional; models are then saved uncompressed
+    MODEL_COMPRESSION = 0
+
+SEVERITY_LEVELS = ('low', 'medium', 'high')
+
+def _score_rows_numpy(ml_scores, rule_counts, amounts, ml_anomaly):
+    """Severity codes (0=low, 1=medium, 2=high) and anomaly flags per row"""
+    # Base severity from ML score
+    severity = np.where(ml_scores < -0.5, 2, np.where(ml_scores < -0.2, 1, 0)).astype(np.int8)
+    
+    # Adjust based on rules
+    severity[rule_counts >= 2] = 2
+    severity[(rule_counts == 1) & (severity == 0)] = 1
+    
+    # Adjust based on amount
+    abs_amounts = np.abs(amounts)
+    severity[abs_amounts > 10000] = 2
+    severity[(abs_amounts > 5000) & (severity != 2)] = 1
+    
+    return severity, ml_anomaly | (rule_counts > 0)
+
+if njit is not None:
+    # Not parallel=True: the kernel is memory-bound, and numba's threading
+    # layers can deadlock when it is called from worker threads
+    @njit(cache=True)
+    def _score_rows(ml_scores, rule_counts, amounts, ml_anomaly):
+        """Severity codes (0=low, 1=medium, 2=high) and anomaly flags per row"""
+        n = ml_scores.shape[0]
+        severity = np.empty(n, dtype=np.int8)
+        is_anomaly = np.empty(n, dtype=np.bool_)
+        for i in range(n):
+            if ml_scores[i] < -0.5:
+                level = 2
+            elif ml_scores[i] < -0.2:
+                level = 1
+            else:
+                level = 0
+            
+            if rule_counts[i] >= 2:
+                level = 2
+            elif rule_counts[i] == 1 and level == 0:
+                level = 1
+            
+            abs_amount = abs(amounts[i])
+            if abs_amount > 10000:
+                level = 2
+            elif abs_amount > 5000 and level != 2:
+                level = 1
+            
+            severity[i] = level
+            is_anomaly[i] = ml_anomaly[i] or rule_counts[i] > 0
+        return severity, is_anomaly
+else:
+    _score_rows = _score_rows_numpy
+
+@lru_cache(maxsize=8)
+def _read_config(path, mtime):
+    """Parsed config file; mtime is part of the key so edits are picked up"""
+    with open(path, 'r') as f:
+        return json.load(f)
+
 class AnomalyDetector:
     """Advanced anomaly detection for financial transactions"""
     
@@ -17,15 +95,37 @@ class AnomalyDetector:
         self.model_path = model_path
         self.scaler_path = 'ml/models/anomaly_scaler.pkl'
         self.config_path = 'ml/models/anomaly_config.json'
+        self.frequency_path = 'ml/models/anomaly_frequencies.pkl'
+        self.last_seen_path = 'ml/models/anomaly_last_seen.pkl'
+        self.importance_path = 'ml/models/anomaly_feature_importance.pkl'
         
         self.model = None
         self.scaler = None
         self.config = self.load_config()
         
+        # Merchant/category frequencies learned at train time
+        self.merchant_freq_ = None
+        self.category_freq_ = None
+        
+        # Latest transaction date per merchant, learned at train time and only
+        # advanced by an explicit update_last_seen(); detect*() never writes it
+        self.last_seen_ = None
+        
+        # Permutation importance of each feature, computed once at train time
+        self.feature_importances_ = None
+        
+        # Per-tree path lengths, precomputed from the fitted forest
+        self._path_lengths = None
+        self._path_denominator = None
+        
+        # Reused 1xF feature row for detect_one
+        self._scratch = np.empty((1, len(self.config['features'])), dtype=np.float32)
+        
     def load_config(self):
         """Load anomaly detection configuration"""
         default_config = {
             'contamination': 0.1,
+            'n_jobs': -1,
             'features': ['amount', 'day_of_week', 'hour', 'amount_zscore', 'frequency'],
             'thresholds': {
                 'high_amount': 10000,
@@ -41,18 +141,24 @@ class AnomalyDetector:
         }
         
         try:
-            with open(self.config_path, 'r') as f:
-                config = json.load(f)
-                return {**default_config, **config}
+            config = _read_config(self.config_path, os.path.getmtime(self.config_path))
+            # Copy, since callers may mutate the nested lists/dicts
+            return {**default_config, **copy.deepcopy(config)}
         except:
             return default_config
     
-    def prepare_features(self, transactions):
-        """Prepare features for anomaly detection"""
+    def prepare_features(self, transactions, merchant_freq=None, category_freq=None, last_seen=None):
+        """Prepare features for anomaly detection
+        
+        merchant_freq/category_freq are the training-set frequency tables;
+        when omitted they are counted over this batch instead. last_seen maps
+        merchant -> latest known date; a merchant's first row in the batch is
+        measured against it. It is only read here.
+        """
         df = pd.DataFrame(transactions)
         
         # Convert dates
-        df['date'] = pd.to_datetime(df['transaction_date'])
+        df['date'] = pd.to_datetime(df['transaction_date'], format='ISO8601', cache=True)
         df['day_of_week'] = df['date'].dt.dayofweek
         df['hour'] = df['date'].dt.hour
         df['day_of_month'] = df['date'].dt.day
@@ -62,108 +168,210 @@ class AnomalyDetector:
         df['amount_zscore'] = (df['amount'] - df['amount'].mean()) / df['amount'].std()
         
         # Calculate frequency features
-        merchant_freq = df['merchant'].value_counts().to_dict()
-        df['merchant_frequency'] = df['merchant'].map(merchant_freq)
+        if merchant_freq is None:
+            merchant_freq = df['merchant'].value_counts().to_dict()
+        df['merchant_frequency'] = df['merchant'].map(merchant_freq).fillna(0)
         
-        category_freq = df['category'].value_counts().to_dict()
-        df['category_frequency'] = df['category'].map(category_freq)
+        if category_freq is None:
+            category_freq = df['category'].value_counts().to_dict()
+        df['category_frequency'] = df['category'].map(category_freq).fillna(0)
         
-        # Time-based features
-        df['days_since_last'] = df.groupby('merchant')['date'].diff().dt.days
-        df['time_variance'] = df.groupby('merchant')['hour'].transform('std')
+        # Time-based features, per merchant without a pandas groupby
+        merchant_codes, merchants = pd.factorize(df['merchant'])
+        df['days_since_last'] = self._days_since_last(
+            merchant_codes, df['date'].to_numpy(dtype='datetime64[ns]'), merchants, last_seen
+        )
+        df['time_variance'] = self._time_variance(merchant_codes, df['hour'].to_numpy(dtype=float))
         
         # Pattern features
         df['weekend'] = df['day_of_week'].isin([5, 6]).astype(int)
         df['business_hours'] = ((df['hour'] >= 9) & (df['hour'] <= 17)).astype(int)
         
-        # Fill NaN values
-        df = df.fillna(0)
-        
         # Select features
         features = self.config['features']
         available_features = [f for f in features if f in df.columns]
         
-        return df[available_features]
+        # float32 is what the trees compare against, so convert once here,
+        # then fill NaN values in the selected columns only
+        X = df[available_features].astype(np.float32)
+        X.fillna(0, inplace=True)
+        return X
+    
+    @staticmethod
+    def _days_since_last(codes, dates, merchants, last_seen=None):
+        """Days since the same merchant's previous transaction (0 if unknown)"""
+        n = len(codes)
+        days = np.zeros(n)
+        if n == 0:
+            return days
+        
+        # Sort by (merchant, date) so each group's rows are adjacent and ordered
+        order = np.lexsort((dates, codes))
+        sorted_codes = codes[order]
+        sorted_dates = dates[order]
+        sorted_days = np.zeros(n)
+        
+        gaps = np.diff(sorted_dates)
+        same_group = (sorted_codes[1:] == sorted_codes[:-1]) & (sorted_codes[1:] >= 0) & ~np.isnat(gaps)
+        sorted_days[1:][same_group] = gaps[same_group] // np.timedelta64(1, 'D')
+        
+        if last_seen is not None:
+            # A group's first row is measured against the merchant's last-seen date;
+            # dates before it cannot be placed, so they stay 0
+            first = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]] & (sorted_codes >= 0))
+            prior = np.array(
+                [last_seen.get(merchant, np.datetime64('NaT')) for merchant in merchants],
+                dtype='datetime64[ns]'
+            )
+            first_gaps = sorted_dates[first] - prior[sorted_codes[first]]
+            known = ~np.isnat(first_gaps) & (first_gaps >= np.timedelta64(0, 'ns'))
+            sorted_days[first[known]] = first_gaps[known] // np.timedelta64(1, 'D')
+        
+        days[order] = sorted_days
+        return days
+    
+    @staticmethod
+    def _advance_last_seen(last_seen, transactions):
+        """Move each merchant's entry in last_seen up to its latest date in transactions"""
+        merchants = pd.Series([t.get('merchant') for t in transactions], dtype=object)
+        dates = pd.to_datetime(
+            [t.get('transaction_date') for t in transactions], format='ISO8601', errors='coerce', cache=True
+        ).to_numpy(dtype='datetime64[ns]')
+        valid = merchants.notna().to_numpy() & ~np.isnat(dates)
+        latest = pd.Series(dates[valid]).groupby(merchants[valid].to_numpy()).max()
+        for merchant, date in zip(latest.index, latest.to_numpy(dtype='datetime64[ns]')):
+            if merchant not in last_seen or date > last_seen[merchant]:
+                last_seen[merchant] = date
+    
+    def update_last_seen(self, transactions, save=True):
+        """Record transactions as seen, so later days_since_last counts from them
+        
+        This is the only way the map changes after training; scoring reads it
+        but never writes it, so re-running detection gives the same answers.
+        """
+        if self.last_seen_ is None:
+            self.last_seen_ = {}
+        self._advance_last_seen(self.last_seen_, transactions)
+        if save:
+            os.makedirs(os.path.dirname(self.last_seen_path), exist_ok=True)
+            joblib.dump(self.last_seen_, self.last_seen_path, compress=MODEL_COMPRESSION)
+    
+    @staticmethod
+    def _time_variance(codes, hours):
+        """Per-merchant sample std of the transaction hour (0 for single rows)"""
+        variance = np.zeros(len(codes))
+        known = codes >= 0
+        if not known.any():
+            return variance
+        
+        counts = np.bincount(codes[known])
+        sums = np.bincount(codes[known], weights=hours[known])
+        sumsq = np.bincount(codes[known], weights=hours[known] ** 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            group_var = (sumsq - sums ** 2 / counts) / (counts - 1)
+        group_std = np.where(counts > 1, np.sqrt(np.clip(group_var, 0, None)), 0.0)
+        
+        variance[known] = group_std[codes[known]]
+        return variance
     
     def train(self, transactions, save=True):
         """Train anomaly detection model"""
         print("Training anomaly detection model...")
         
-        # Prepare features
-        X = self.prepare_features(transactions)
+        # Frequency tables are fixed at train time and reused by detect()
+        self.merchant_freq_ = pd.Series([t.get('merchant') for t in transactions]).value_counts().to_dict()
+        self.category_freq_ = pd.Series([t.get('category') for t in transactions]).value_counts().to_dict()
         
-        # Scale features
-        self.scaler = StandardScaler()
-        X_scaled = self.scaler.fit_transform(X)
+        # Prepare features, then record each merchant's latest date for detect()
+        X = self.prepare_features(transactions, self.merchant_freq_, self.category_freq_)
+        self.last_seen_ = {}
+        self._advance_last_seen(self.last_seen_, transactions)
         
-        # Train multiple models
+        # Scale features in place (plain ndarray, no DataFrame round trip)
+        self.scaler = StandardScaler(copy=False)
+        X_scaled = self.scaler.fit_transform(X.to_numpy())
+        
+        # Train multiple models. LOF and the RBF OneClassSVM scale
+        # quadratically with the training set, so they are opt-in
         models = {
             'isolation_forest': IsolationForest(
                 contamination=self.config['contamination'],
                 random_state=42,
-                n_estimators=100
-            ),
-            'local_outlier_factor': LocalOutlierFactor(
+                n_estimators=100,
+                n_jobs=self.config.get('n_jobs', -1)
+            )
+        }
+        if self.config.get('use_lof', False):
+            models['local_outlier_factor'] = LocalOutlierFactor(
                 contamination=self.config['contamination'],
                 novelty=True
-            ),
-            'one_class_svm': OneClassSVM(
+            )
+        if self.config.get('use_ocsvm', False):
+            models['one_class_svm'] = OneClassSVM(
                 nu=self.config['contamination'],
                 kernel='rbf',
                 gamma='auto'
             )
-        }
         
         # Ensemble approach
         predictions = []
-        for name, model in models.items():
+        ocsvm_max_samples = self.config.get('ocsvm_max_samples', 10000)
+        for name, model in list(models.items()):
             try:
-                if name == 'local_outlier_factor':
-                    # LOF needs to be fit without labels
-                    model.fit(X_scaled)
+                if name == 'one_class_svm' and len(X_scaled) > ocsvm_max_samples:
+                    # Fit the kernel model on a subsample to bound its cost
+                    rng = np.random.RandomState(42)
+                    model.fit(X_scaled[rng.choice(len(X_scaled), ocsvm_max_samples, replace=False)])
                 else:
                     model.fit(X_scaled)
                 
                 # Get predictions (-1 for anomalies, 1 for normal)
-                if hasattr(model, 'predict'):
-                    pred = model.predict(X_scaled)
-                    predictions.append(pred)
-                elif hasattr(model, 'fit_predict'):
-                    pred = model.fit_predict(X_scaled)
-                    predictions.append(pred)
+                predictions.append(model.predict(X_scaled))
             except Exception as e:
                 print(f"Model {name} failed: {e}")
+                models.pop(name)
                 continue
         
         # Combine predictions
-        if predictions:
-            # Vote by majority
-            combined = np.sum(predictions, axis=0)
-            final_predictions = np.where(combined < 0, -1, 1)
-            
+        if 'isolation_forest' in models:
             # Use Isolation Forest as base model
             self.model = models['isolation_forest']
+            
+            if len(predictions) > 1:
+                # Vote by majority
+                combined = np.sum(predictions, axis=0)
+                final_predictions = np.where(combined < 0, -1, 1)
+            else:
+                final_predictions = predictions[0]
         else:
             # Fallback to Isolation Forest
             self.model = IsolationForest(
                 contamination=self.config['contamination'],
-                random_state=42
+                random_state=42,
+                n_jobs=self.config.get('n_jobs', -1)
             )
             self.model.fit(X_scaled)
             final_predictions = self.model.predict(X_scaled)
         
         # Calculate anomaly scores
-        if hasattr(self.model, 'decision_function'):
-            scores = self.model.decision_function(X_scaled)
-        elif hasattr(self.model, 'score_samples'):
-            scores = self.model.score_samples(X_scaled)
-        else:
-            scores = final_predictions
+        self._cache_path_lengths()
+        scores = self._decision_function(X_scaled)
         
         # Analyze results
         n_anomalies = sum(final_predictions == -1)
         print(f"Detected {n_anomalies} anomalies ({n_anomalies/len(transactions)*100:.1f}%)")
         
+        # Feature importance: how much shuffling each feature changes the labels.
+        # IsolationForest has no feature_importances_, so compute it here once
+        with joblib.parallel_backend('threading'):
+            importance = permutation_importance(
+                self.model, X_scaled, final_predictions, scoring='accuracy',
+                n_repeats=5, n_jobs=self.config.get('n_jobs', -1), random_state=42
+            )
+        self.feature_importances_ = {
+            feature: float(value) for feature, value in zip(X.columns, importance.importances_mean)
+        }
+        
         # Save model
         if save:
             self.save_model()
@@ -178,139 +386,337 @@ class AnomalyDetector:
     
     def detect(self, transactions):
         """Detect anomalies in transactions"""
+        bulk = self.detect_bulk(transactions)
+        
+        # Build dicts only for flagged rows
+        return [
+            self._anomaly_record(
+                transactions[i], i, bulk['amount'][i], bulk['ml_score'][i],
+                bulk['ml_anomaly'][i], bulk['rule_reasons'][i] or [], bulk['severity'][i]
+            )
+            for i in np.flatnonzero(bulk['is_anomaly'])
+        ]
+    
+    def detect_one(self, transaction):
+        """Detect whether a single transaction is anomalous, without pandas
+        
+        Gives the same result as detect([transaction]), returning the
+        anomaly dict or None.
+        """
+        if not self.model or not self.scaler:
+            self.load_model()
+        
+        features, values, amount, date = self._single_features(transaction)
+        if self._scratch.shape[1] != len(features):
+            self._scratch = np.empty((1, len(features)), dtype=np.float32)
+        row = self._scratch
+        row[0] = values
+        np.nan_to_num(row, copy=False, nan=0.0)
+        
+        # Scale in place and score on the calling thread
+        row -= self.scaler.mean_
+        row /= self.scaler.scale_
+        score = self._decision_function(row, n_jobs=1)[0]
+        ml_anomaly = score < 0
+        
+        rule_reasons = self._rule_reasons(amount, date, transaction.get('merchant'))
+        severity, is_anomaly = _score_rows(
+            np.array([score]), np.array([len(rule_reasons)]), np.array([amount]), np.array([ml_anomaly])
+        )
+        if not is_anomaly[0]:
+            return None
+        
+        return self._anomaly_record(transaction, 0, amount, score, ml_anomaly, rule_reasons, severity[0])
+    
+    def detect_each(self, transactions):
+        """detect_one for every transaction, with a single model call
+        
+        Features are built per transaction, never across the list, so each
+        result equals detect_one(transaction) whatever else is scored with it.
+        """
+        if not self.model or not self.scaler:
+            self.load_model()
+        if not transactions:
+            return []
+        
+        singles = [self._single_features(t) for t in transactions]
+        features = singles[0][0]
+        if any(single[0] != features for single in singles):
+            raise ValueError("Transactions provide different feature columns")
+        
+        X = np.array([single[1] for single in singles], dtype=np.float32)
+        np.nan_to_num(X, copy=False, nan=0.0)
+        X -= self.scaler.mean_
+        X /= self.scaler.scale_
+        scores = self._decision_function(X)
+        ml_anomaly = scores < 0
+        
+        amounts = np.array([single[2] for single in singles])
+        rule_reasons = [
+            self._rule_reasons(amount, date, t.get('merchant'))
+            for t, (_, _, amount, date) in zip(transactions, singles)
+        ]
+        severity, is_anomaly = _score_rows(
+            scores, np.array([len(reasons) for reasons in rule_reasons]), amounts, ml_anomaly
+        )
+        return [
+            self._anomaly_record(t, 0, amounts[i], scores[i], ml_anomaly[i], rule_reasons[i], severity[i])
+            if is_anomaly[i] else None
+            for i, t in enumerate(transactions)
+        ]
+    
+    def _single_features(self, transaction):
+        """Feature names and values for one transaction, plus its amount and parsed date"""
+        amount = float(transaction.get('amount', 0))
+        date_str = transaction.get('transaction_date')
+        date = datetime.fromisoformat(date_str) if date_str else None
+        
+        # Features exactly as prepare_features builds them for a batch of one
+        computed = {
+            'amount': amount,
+            'amount_log': np.log1p(abs(amount)),
+            'amount_zscore': 0.0,  # std of a single value is undefined
+            'merchant_frequency': self._single_frequency(self.merchant_freq_, transaction.get('merchant')),
+            'category_frequency': self._single_frequency(self.category_freq_, transaction.get('category')),
+            'days_since_last': self._single_days_since_last(transaction.get('merchant'), date),
+            'time_variance': 0.0,
+        }
+        # Date features are always present (NaN -> 0 below) so the row has the
+        # same columns the scaler and model were fitted on
+        if date is not None:
+            computed.update({
+                'day_of_week': date.weekday(),
+                'hour': date.hour,
+                'day_of_month': date.day,
+                'weekend': int(date.weekday() >= 5),
+                'business_hours': int(9 <= date.hour <= 17),
+            })
+        else:
+            computed.update({
+                'day_of_week': np.nan,
+                'hour': np.nan,
+                'day_of_month': np.nan,
+                'weekend': 0,
+                'business_hours': 0,
+            })
+        
+        features = [f for f in self.config['features'] if f in computed or f in transaction]
+        values = []
+        for feature in features:
+            value = computed.get(feature, transaction.get(feature))
+            values.append(0.0 if value is None else value)
+        return features, values, amount, date
+    
+    def _single_days_since_last(self, merchant, date):
+        """days_since_last for one row against last_seen_, as prepare_features measures it"""
+        if self.last_seen_ is None or merchant is None or date is None:
+            return 0.0
+        
+        if date.tzinfo is not None:
+            date = date.astimezone(timezone.utc).replace(tzinfo=None)
+        date = np.datetime64(date, 'ns')
+        
+        previous = self.last_seen_.get(merchant)
+        if previous is None or date < previous:
+            return 0.0
+        return float((date - previous) // np.timedelta64(1, 'D'))
+    
+    @staticmethod
+    def _single_frequency(table, value):
+        """Frequency lookup for one row, as prepare_features maps a column"""
+        if value is None:
+            return 0
+        if table is None:
+            return 1  # counted over a batch of one
+        return table.get(value, 0)
+    
+    def _anomaly_record(self, transaction, index, amount, score, ml_anomaly, rule_reasons, severity):
+        """Result dict for one flagged transaction"""
+        amount = float(amount)
+        return {
+            'transaction_id': transaction.get('id'),
+            'index': int(index),
+            'amount': amount,
+            'description': transaction.get('description', ''),
+            'merchant': transaction.get('merchant', ''),
+            'date': transaction.get('transaction_date'),
+            'ml_score': float(score),
+            'ml_anomaly': ml_anomaly,
+            'rule_reasons': rule_reasons,
+            'severity': SEVERITY_LEVELS[severity],
+            'suggested_action': self._get_suggested_action(ml_anomaly, rule_reasons, amount)
+        }
+    
+    def detect_bulk(self, transactions):
+        """Score every transaction, returned as columns of index-aligned arrays
+        
+        severity holds codes into SEVERITY_LEVELS; rule_reasons is None for
+        rows where no rule fired.
+        """
         if not self.model or not self.scaler:
             self.load_model()
         
         # Prepare features
-        X = self.prepare_features(transactions)
+        X = self.prepare_features(transactions, self.merchant_freq_, self.category_freq_, self.last_seen_)
         
         # Scale features
-        X_scaled = self.scaler.transform(X)
+        X_scaled = self.scaler.transform(X.to_numpy())
         
-        # Predict anomalies
-        predictions = self.model.predict(X_scaled)
-        
-        # Get anomaly scores
-        if hasattr(self.model, 'decision_function'):
-            scores = self.model.decision_function(X_scaled)
-        elif hasattr(self.model, 'score_samples'):
-            scores = self.model.score_samples(X_scaled)
-        else:
-            scores = predictions
+        # Get anomaly scores in a single pass over the trees;
+        # IsolationForest.predict is exactly decision_function < 0
+        scores = self._decision_function(X_scaled)
+        predictions = np.where(scores < 0, -1, 1)
         
         # Apply rule-based checks
-        rule_based_anomalies = self._rule_based_detection(transactions)
+        arrays = self._as_arrays(transactions)
+        n = len(transactions)
+        rule_reasons = np.full(n, None, dtype=object)
+        rule_counts = np.zeros(n, dtype=np.int64)
+        for rule in self._rule_based_detection(transactions, arrays):
+            rule_reasons[rule['index']] = rule['reasons']
+            rule_counts[rule['index']] = len(rule['reasons'])
+        
+        # Score every row in one kernel call
+        amounts = arrays['amount']
+        ml_anomaly = np.asarray(predictions) == -1
+        scores = np.asarray(scores, dtype=np.float64)
+        severity, is_anomaly = _score_rows(scores, rule_counts, amounts, ml_anomaly)
         
-        # Combine results
-        anomalies = []
-        for i, (pred, score) in enumerate(zip(predictions, scores)):
-            transaction = transactions[i]
-            
-            # Check ML prediction
-            is_ml_anomaly = pred == -1
-            
-            # Check rule-based
-            rule_reasons = []
-            for rule in rule_based_anomalies:
-                if rule['index'] == i:
-                    rule_reasons.append(rule['reason'])
+        return {
+            'transaction_id': arrays['id'],
+            'amount': amounts,
+            'ml_score': scores,
+            'ml_anomaly': ml_anomaly,
+            'rule_count': rule_counts,
+            'rule_reasons': rule_reasons,
+            'severity': severity,
+            'is_anomaly': is_anomaly,
+        }
+    
+    def _cache_path_lengths(self):
+        """Precompute each tree's per-node path length once the forest is fitted"""
+        path_lengths = []
+        for tree in self.model.estimators_:
+            tree_ = tree.tree_
+            children_left = tree_.children_left
+            children_right = tree_.children_right
             
-            # Combine decision
-            is_anomaly = is_ml_anomaly or len(rule_reasons) > 0
+            # Children are always numbered after their parent
+            depths = np.zeros(tree_.node_count)
+            for node in range(tree_.node_count):
+                if children_left[node] != -1:
+                    depths[children_left[node]] = depths[children_right[node]] = depths[node] + 1
             
-            if is_anomaly:
-                anomaly = {
-                    'transaction_id': transaction.get('id'),
-                    'index': i,
-                    'amount': float(transaction.get('amount', 0)),
-                    'description': transaction.get('description', ''),
-                    'merchant': transaction.get('merchant', ''),
-                    'date': transaction.get('transaction_date'),
-                    'ml_score': float(score) if isinstance(score, (np.ndarray, np.generic)) else float(score),
-                    'ml_anomaly': is_ml_anomaly,
-                    'rule_reasons': rule_reasons,
-                    'severity': self._calculate_severity(
-                        float(score) if isinstance(score, (np.ndarray, np.generic)) else float(score),
-                        len(rule_reasons),
-                        float(transaction.get('amount', 0))
-                    ),
-                    'suggested_action': self._get_suggested_action(
-                        is_ml_anomaly,
-                        rule_reasons,
-                        float(transaction.get('amount', 0))
-                    )
-                }
-                anomalies.append(anomaly)
+            # Depth of the leaf plus the expected depth of its unbuilt subtree
+            path_lengths.append(depths + _average_path_length(tree_.n_node_samples))
         
-        return anomalies
+        self._path_lengths = path_lengths
+        self._path_denominator = _average_path_length([self.model.max_samples_])[0]
     
-    def _rule_based_detection(self, transactions):
+    def _decision_function(self, X_scaled, n_jobs=None):
+        """IsolationForest.decision_function using the cached path lengths"""
+        if self._path_lengths is None:
+            self._cache_path_lengths()
+        
+        # The low-level Tree.apply skips input validation, so hand it C-contiguous float32
+        X_scaled = np.ascontiguousarray(X_scaled, dtype=np.float32)
+        n_features = X_scaled.shape[1]
+        
+        def tree_path_lengths(tree, features, path_lengths):
+            X_subset = X_scaled if len(features) == n_features else X_scaled[:, features]
+            return path_lengths[tree.tree_.apply(X_subset)]
+        
+        trees = zip(self.model.estimators_, self.model.estimators_features_, self._path_lengths)
+        if n_jobs is None:
+            n_jobs = self.config.get('n_jobs', -1)
+        if n_jobs == 1:
+            # Small inputs: thread dispatch would cost more than the traversal
+            depths = sum(tree_path_lengths(*tree) for tree in trees)
+        else:
+            # Tree traversal releases the GIL, so trees are scored on threads
+            per_tree = joblib.Parallel(n_jobs=n_jobs, prefer='threads')(
+                joblib.delayed(tree_path_lengths)(*tree) for tree in trees
+            )
+            depths = np.sum(per_tree, axis=0)
+        
+        scores = -2 ** (-depths / (len(self.model.estimators_) * self._path_denominator))
+        return scores - self.model.offset_
+    
+    @staticmethod
+    def _as_arrays(transactions):
+        """Columns the rules need, pulled straight from the dicts without a DataFrame"""
+        n = len(transactions)
+        dates = pd.to_datetime(
+            [t.get('transaction_date') for t in transactions], format='ISO8601', errors='coerce', cache=True
+        )
+        return {
+            'id': np.array([t.get('id') for t in transactions], dtype=object),
+            'amount': np.fromiter((float(t.get('amount') or 0) for t in transactions), dtype=np.float64, count=n),
+            'hour': dates.hour.to_numpy(dtype=float),
+            'weekday': dates.weekday.to_numpy(dtype=float),
+            'merchant': np.array([t.get('merchant') or '' for t in transactions], dtype=object),
+        }
+    
+    def _rule_based_detection(self, transactions, arrays=None):
         """Rule-based anomaly detection"""
         anomalies = []
         thresholds = self.config['thresholds']
-        
-        for i, txn in enumerate(transactions):
+        if not transactions:
+            return anomalies
+        
+        # Evaluate every rule as a vectorized mask over the whole batch
+        if arrays is None:
+            arrays = self._as_arrays(transactions)
+        amt = arrays['amount']
+        hours = arrays['hour']
+        
+        high = np.abs(amt) > thresholds['high_amount']
+        round_ = (amt % 1000 == 0) & (np.abs(amt) >= 5000)
+        odd_time = (hours < 5) | (hours > 22)  # Outside normal business hours
+        weekend = arrays['weekday'] >= 5
+        # Plain substring search (regex=False) rather than a regex match per row
+        new_merch = pd.Series(arrays['merchant']).str.contains('new', case=False, regex=False, na=False).to_numpy(dtype=bool)
+        
+        # Only build reason strings for flagged rows
+        for i in np.flatnonzero(high | round_ | odd_time | weekend | new_merch):
             reasons = []
-            
-            # High amount check
-            amount = float(txn.get('amount', 0))
-            if abs(amount) > thresholds['high_amount']:
-                reasons.append(f"High amount: ${amount:,.2f}")
-            
-            # Round amount check
-            if amount % 1000 == 0 and abs(amount) >= 5000:
-                reasons.append(f"Round amount: ${amount:,.2f}")
-            
-            # Unusual time check
-            date_str = txn.get('transaction_date')
-            if date_str:
-                try:
-                    date = pd.to_datetime(date_str)
-                    if date.hour < 5 or date.hour > 22:  # Outside normal business hours
-                        reasons.append(f"Unusual time: {date.hour}:00")
-                    
-                    if date.weekday() >= 5:  # Weekend
-                        reasons.append("Weekend transaction")
-                except:
-                    pass
-            
-            # New merchant check
-            merchant = txn.get('merchant', '')
-            if merchant and 'new' in merchant.lower():
+            if high[i]:
+                reasons.append(f"High amount: ${amt[i]:,.2f}")
+            if round_[i]:
+                reasons.append(f"Round amount: ${amt[i]:,.2f}")
+            if odd_time[i]:
+                reasons.append(f"Unusual time: {int(hours[i])}:00")
+            if weekend[i]:
+                reasons.append("Weekend transaction")
+            if new_merch[i]:
                 reasons.append("New merchant")
             
-            if reasons:
-                anomalies.append({
-                    'index': i,
-                    'transaction_id': txn.get('id'),
-                    'reasons': reasons
-                })
+            anomalies.append({
+                'index': int(i),
+                'transaction_id': transactions[i].get('id'),
+                'reasons': reasons
+            })
         
         return anomalies
     
-    def _calculate_severity(self, ml_score, rule_count, amount):
-        """Calculate anomaly severity"""
-        # Base severity from ML score
-        if ml_score < -0.5:
-            severity = 'high'
-        elif ml_score < -0.2:
-            severity = 'medium'
-        else:
-            severity = 'low'
-        
-        # Adjust based on rules
-        if rule_count >= 2:
-            severity = 'high'
-        elif rule_count == 1 and severity == 'low':
-            severity = 'medium'
-        
-        # Adjust based on amount
-        if abs(amount) > 10000:
-            severity = 'high'
-        elif abs(amount) > 5000 and severity != 'high':
-            severity = 'medium'
-        
-        return severity
+    def _rule_reasons(self, amount, date, merchant):
+        """Rule-based reasons for a single transaction (see _rule_based_detection)"""
+        thresholds = self.config['thresholds']
+        reasons = []
+        
+        if abs(amount) > thresholds['high_amount']:
+            reasons.append(f"High amount: ${amount:,.2f}")
+        if amount % 1000 == 0 and abs(amount) >= 5000:
+            reasons.append(f"Round amount: ${amount:,.2f}")
+        if date is not None:
+            if date.hour < 5 or date.hour > 22:
+                reasons.append(f"Unusual time: {date.hour}:00")
+            if date.weekday() >= 5:
+                reasons.append("Weekend transaction")
+        if merchant and 'new' in str(merchant).lower():
+            reasons.append("New merchant")
+        
+        return reasons
     
     def _get_suggested_action(self, is_ml_anomaly, rule_reasons, amount):
         """Get suggested action for anomaly"""
@@ -324,12 +730,19 @@ class AnomalyDetector:
             return "Monitor and review if pattern continues"
     
     def save_model(self):
-        """Save model and scaler"""
-        import os
+        """Save model, scaler and the tables learned at train time"""
         os.makedirs(os.path.dirname(self.model_path), exist_ok=True)
         
-        joblib.dump(self.model, self.model_path)
-        joblib.dump(self.scaler, self.scaler_path)
+        # LZ4 level 1: much smaller files for little CPU; joblib.load
+        # detects the compression by itself
+        joblib.dump(self.model, self.model_path, compress=MODEL_COMPRESSION)
+        joblib.dump(self.scaler, self.scaler_path, compress=MODEL_COMPRESSION)
+        joblib.dump(
+            {'merchant': self.merchant_freq_, 'category': self.category_freq_},
+            self.frequency_path, compress=MODEL_COMPRESSION
+        )
+        joblib.dump(self.last_seen_, self.last_seen_path, compress=MODEL_COMPRESSION)
+        joblib.dump(self.feature_importances_, self.importance_path, compress=MODEL_COMPRESSION)
         
         with open(self.config_path, 'w') as f:
             json.dump(self.config, f, indent=2)
@@ -337,11 +750,22 @@ class AnomalyDetector:
         print(f"Model saved to {self.model_path}")
     
     def load_model(self):
-        """Load model and scaler"""
+        """Load model, scaler and the tables learned at train time"""
         try:
             if os.path.exists(self.model_path):
                 self.model = joblib.load(self.model_path)
                 self.scaler = joblib.load(self.scaler_path)
+                
+                # Models saved before the tables existed fall back to batch counts
+                if os.path.exists(self.frequency_path):
+                    frequencies = joblib.load(self.frequency_path)
+                    self.merchant_freq_ = frequencies['merchant']
+                    self.category_freq_ = frequencies['category']
+                if os.path.exists(self.last_seen_path):
+                    self.last_seen_ = joblib.load(self.last_seen_path)
+                if os.path.exists(self.importance_path):
+                    self.feature_importances_ = joblib.load(self.importance_path)
+                self._cache_path_lengths()
                 print("Anomaly detection model loaded successfully")
                 return True
         except Exception as e:
@@ -356,20 +780,82 @@ class AnomalyDetector:
     
     def get_feature_importance(self):
         """Get feature importance for anomalies"""
-        if not self.model or not hasattr(self.model, 'feature_importances_'):
+        if not self.feature_importances_:
             return {}
+        return dict(self.feature_importances_)
+
+class BatchingAnomalyDetector:
+    """Collect single-transaction requests and score them in batches
+    
+    A background thread drains the queue into batches of up to max_batch
+    transactions (or whatever arrived within max_wait_ms) and scores each
+    batch with one detect_each call. Features are still built per
+    transaction, so a result never depends on what else was queued with it.
+    """
+    
+    def __init__(self, detector=None, max_batch=512, max_wait_ms=10, max_queue=10000):
+        self.detector = detector or AnomalyDetector()
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        
+        # Bounded, so producers block instead of growing memory without limit
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name='anomaly-batcher', daemon=True)
+        self._thread.start()
+    
+    def submit(self, transaction):
+        """Queue a transaction; the future resolves to its anomaly dict or None"""
+        future = Future()
+        self._queue.put((transaction, future))
+        return future
+    
+    def close(self):
+        """Score whatever is queued, then stop the background thread"""
+        self._queue.put(None)
+        self._thread.join()
+    
+    def _run(self):
+        running = True
+        while running:
+            item = self._queue.get()
+            if item is None:
+                break
+            
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            
+            self._score_batch(batch)
+    
+    def _score_batch(self, batch):
+        batch = [(txn, future) for txn, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
         
         try:
-            features = self.config['features']
-            importances = self.model.feature_importances_
-            
-            return {
-                feature: importance
-                for feature, importance in zip(features, importances)
-                if feature in features
-            }
-        except:
-            return {}
+            results = self.detector.detect_each([txn for txn, _ in batch])
+        except Exception:
+            # Let each request succeed or fail on its own
+            for txn, future in batch:
+                try:
+                    future.set_result(self.detector.detect_one(txn))
+                except Exception as e:
+                    future.set_exception(e)
+            return
+        
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
 
 # Training script
 if __name__ == "__main__":
@@ -148,6 +148,11 @@ init_database() {
     docker-compose -f docker-compose.prod.yml exec -T backend \
         python -m alembic upgrade head
     
+    # Create the default admin user (once per deploy, not per worker)
+    log "Creating default admin user..."
+    docker-compose -f docker-compose.prod.yml exec -T backend \
+        python -m app.cli create-admin
+    
     # Seed initial data
     log "Seeding initial data..."
     docker-compose -f docker-compose.prod.yml exec -T backend \